@@ -0,0 +1,301 @@
+"""
+Benchmarks for the s3nb managers against a local s3 stand-in.
+
+By default s3 is moto's in-process mock (pip install "moto<2"), or pass
+--endpoint host:port to use a local s3-compatible server such as minio.
+--latency adds a fixed delay to every s3 request to mimic a real network.
+
+    python benchmarks/bench_s3nb.py --latency 0.02 --output bench.json
+
+Results are printed as JSON: for each scenario, the s3 requests issued by
+verb, the latency percentiles of the contents operation and its throughput.
+"""
+from __future__ import print_function
+
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import boto
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+from IPython.config import Config
+from IPython.config.configurable import Configurable
+
+from s3nb.metrics import request_verb
+
+
+KB = 1024
+MB = 1024 * KB
+
+
+class RequestRecorder(object):
+    """ counts every s3 request by verb and optionally delays it """
+
+    def __init__(self, latency=0.0, serialize=False):
+        self.latency = latency
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        # moto's in-process mock isn't thread-safe, so requests to it are made one at a time
+        self._serialize = threading.Lock() if serialize else None
+        self._make_request = S3Connection.make_request
+
+    def install(self):
+        recorder = self
+
+        def make_request(conn, method, bucket='', key='', headers=None, data='', query_args=None, *args, **kwargs):
+            with recorder._lock:
+                recorder.counts[request_verb(method, key, headers, query_args)] += 1
+            if recorder.latency:
+                time.sleep(recorder.latency)
+            if recorder._serialize is None:
+                return recorder._make_request(conn, method, bucket, key, headers, data, query_args, *args, **kwargs)
+            with recorder._serialize:
+                return recorder._make_request(conn, method, bucket, key, headers, data, query_args, *args, **kwargs)
+
+        S3Connection.make_request = make_request
+
+    def uninstall(self):
+        S3Connection.make_request = self._make_request
+
+    @contextmanager
+    def measure(self):
+        with self._lock:
+            self.counts.clear()
+        yield self.counts
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+    return {'p50': pct(50), 'p90': pct(90), 'p99': pct(99), 'max': samples[-1]}
+
+
+def run(recorder, name, func, repeat=1, threads=1, **params):
+    """ time repeat calls of func on each of threads threads """
+    timings = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(thread_num):
+        for i in range(repeat):
+            start = time.time()
+            try:
+                func(thread_num, i)
+            except Exception as e:
+                with lock:
+                    errors.append('%s: %s' % (type(e).__name__, e))
+                continue
+            elapsed = time.time() - start
+            with lock:
+                timings.append(elapsed)
+
+    with recorder.measure() as counts:
+        start = time.time()
+        workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        wall = time.time() - start
+    result = {
+        'scenario': name,
+        'params': params,
+        'operations': len(timings),
+        'seconds': wall,
+        'throughput': len(timings) / wall if wall else None,
+        'latency': percentiles(timings),
+        'requests': dict(counts),
+        'requests_per_operation': sum(counts.values()) / float(len(timings) or 1),
+        'errors': errors,
+    }
+    print('%-40s %8.3fs p50=%.4fs requests=%s' % (
+        name + ' ' + json.dumps(params, sort_keys=True), wall,
+        result['latency'].get('p50', 0), dict(counts)), file=sys.stderr)
+    return result
+
+
+def notebook_json(size):
+    from IPython import nbformat
+    nb = nbformat.v4.new_notebook()
+    nb.cells.append(nbformat.v4.new_code_cell('print(1)'))
+    nb.cells.append(nbformat.v4.new_markdown_cell('x' * size))
+    return nb
+
+
+def populate(bucket, prefix, count):
+    for i in range(count):
+        bucket.new_key('%s/f%06d.txt' % (prefix, i)).set_contents_from_string('x')
+
+
+class ContentsBench(object):
+    """ S3ContentsManager, IPython 3.x+ """
+    name = 'S3ContentsManager'
+
+    def __init__(self, base_uri, options):
+        from s3nb.ipy3 import S3ContentsManager
+
+        class BenchContentsManager(S3ContentsManager):
+            # the notary's sqlite db only works on the thread that opened it, and isn't s3 work anyway
+            def check_and_sign(self, nb, path=''):
+                pass
+
+            def mark_trusted_cells(self, nb, path=''):
+                pass
+
+        config = {'s3_base_uri': base_uri}
+        config.update(options)
+        self.cm = BenchContentsManager(config=Config({'BenchContentsManager': config}))
+
+    def list(self, path):
+        self.cm.s3_cache.clear()
+        return self.cm.get(path, type='directory')
+
+    def save(self, path, nb):
+        return self.cm.save({'type': 'notebook', 'content': nb}, path)
+
+    def open(self, path):
+        return self.cm.get(path)
+
+    def rename(self, old_path, new_path):
+        return self.cm.rename(old_path, new_path)
+
+
+class NotebookBench(object):
+    """ S3NotebookManager, IPython 2.x """
+    name = 'S3NotebookManager'
+
+    def __init__(self, base_uri, options):
+        from s3nb.ipy2 import S3NotebookManager
+        config = {'s3_base_uri': base_uri}
+        config.update(options)
+        parent = Configurable(config=Config({'S3NotebookManager': config}))
+        self.nm = S3NotebookManager(parent=parent)
+
+    @staticmethod
+    def _split(path):
+        path, _, name = path.rpartition('/')
+        return path, name
+
+    def list(self, path):
+        return self.nm.list_dirs(path) + self.nm.list_notebooks(path)
+
+    def save(self, path, nb):
+        path, name = self._split(path)
+        return self.nm.save_notebook({'content': nb}, name, path)
+
+    def open(self, path):
+        path, name = self._split(path)
+        return self.nm.get_notebook(name, path)
+
+    def rename(self, old_path, new_path):
+        path, name = self._split(old_path)
+        new_path, new_name = self._split(new_path)
+        return self.nm.update_notebook({'name': new_name, 'path': new_path}, name, path)
+
+
+def bench_manager(bench, bucket, prefix, recorder, args):
+    results = []
+    for count in args.list_sizes:
+        folder = 'list%d' % count
+        populate(bucket, prefix + folder, count)
+        results.append(run(recorder, 'list', lambda t, i: bench.list(folder), repeat=args.repeat, keys=count))
+
+    for size in args.notebook_sizes:
+        nb = notebook_json(size)
+        path = 'open/nb%d.ipynb' % size
+        results.append(run(recorder, 'save', lambda t, i: bench.save(path, nb), repeat=args.repeat, bytes=size))
+        results.append(run(recorder, 'open', lambda t, i: bench.open(path), repeat=args.repeat, bytes=size))
+
+    nb = notebook_json(args.storm_size)
+    results.append(run(
+        recorder, 'autosave_storm', lambda t, i: bench.save('storm/nb%d.ipynb' % t, nb),
+        repeat=args.storm_saves, threads=args.storm_users, users=args.storm_users, bytes=args.storm_size))
+
+    bench.save('rename/a.ipynb', notebook_json(KB))
+    names = ['rename/a.ipynb', 'rename/b.ipynb']
+    results.append(run(
+        recorder, 'rename', lambda t, i: bench.rename(names[i % 2], names[(i + 1) % 2]), repeat=args.repeat))
+    return results
+
+
+def sizes(value):
+    units = {'k': KB, 'm': MB}
+    out = []
+    for part in value.split(','):
+        part = part.strip().lower()
+        out.append(int(float(part[:-1]) * units[part[-1]]) if part[-1] in units else int(part))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint', help='host:port of a local s3-compatible server instead of moto')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every s3 request')
+    parser.add_argument('--list-sizes', type=sizes, default=sizes('10,1000'), help='e.g. 10,1000,50000')
+    parser.add_argument('--notebook-sizes', type=sizes, default=sizes('1k,1m,10m'), help='e.g. 1k,1m,200m')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--storm-users', type=int, default=10)
+    parser.add_argument('--storm-saves', type=int, default=5)
+    parser.add_argument('--storm-size', type=sizes, default=[100 * KB])
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=JSON',
+                        help='extra manager option, e.g. s3_cache_ttl=0')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+    args.storm_size = args.storm_size[0]
+    options = dict((o.split('=', 1)[0], json.loads(o.split('=', 1)[1])) for o in args.option)
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    mock = None
+    if args.endpoint:
+        host, port = args.endpoint.rsplit(':', 1)
+        connect_s3 = boto.connect_s3
+        boto.connect_s3 = lambda *a, **kw: connect_s3(
+            host=host, port=int(port), is_secure=False, calling_format=OrdinaryCallingFormat())
+    else:
+        from moto import mock_s3_deprecated
+        mock = mock_s3_deprecated()
+        mock.start()
+
+    recorder = RequestRecorder(latency=args.latency, serialize=mock is not None)
+    bucket_name = 's3nb-bench-' + uuid.uuid4().hex[:8]
+    bucket = boto.connect_s3().create_bucket(bucket_name)
+    recorder.install()
+    report = {'latency': args.latency, 'options': options, 'managers': {}}
+    try:
+        for cls in (ContentsBench, NotebookBench):
+            prefix = cls.name + '/'
+            try:
+                bench = cls('s3://%s/%s' % (bucket_name, prefix), options)
+            except ImportError as e:
+                report['managers'][cls.name] = {'skipped': str(e)}
+                continue
+            report['managers'][cls.name] = bench_manager(bench, bucket, prefix, recorder, args)
+    finally:
+        recorder.uninstall()
+        if mock is not None:
+            mock.stop()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ except ImportError:
 
 try:
     from .ipy3 import S3ContentsManager
+    from .checkpoints import S3Checkpoints
     imported = True
 except ImportError:
     pass
@@ -0,0 +1,141 @@
+"""
+Large cell outputs and attachments stored once, keyed by their content hash.
+
+c.S3ContentsManager.s3_output_blobs = True
+
+moves every output or attachment value of at least s3_blob_min_size
+characters into <s3 prefix>/.ipynb_blobs/<sha256> when a notebook is saved,
+leaving 's3nb-blob:sha256:<sha256>' in the notebook in its place.  Blobs
+never change once written, so a save only uploads those the server hasn't
+seen before, and they are shared by every notebook, copy and checkpoint that
+contains the same output.
+
+Nothing deletes a blob when the last notebook referring to it is changed or
+deleted.  Sweep the blobs no notebook or checkpoint under the prefix refers
+to any more, and that are older than --min-age days, with:
+
+    python -m s3nb.blobs s3://bucket/notebook/prefix/ [--min-age 7] [--dry-run]
+
+The age keeps blobs uploaded for saves still being written behind.  Servers
+also remember for a day which blobs they have stored or read and don't
+upload those again, so a server that saves a blob's output again within a
+day of a sweep deleting it leaves a notebook that can't be opened; sweep
+when notebooks aren't being edited, or at least not with outputs that were
+just cleared.
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import logging
+
+from IPython import nbformat
+from IPython.utils.py3compat import string_types
+
+from .compression import decompressing_reader
+from .timestamps import S3_TIMEFORMAT_BUCKET_LIST, parse_s3_time, utcnow
+
+
+BLOB_DIR = '.ipynb_blobs'
+REF_PREFIX = 's3nb-blob:sha256:'
+
+
+def _values(nb):
+    """ (mapping, field) for every output and attachment value in nb """
+    for cell in nb.get('cells', ()):
+        for output in cell.get('outputs', ()):
+            data = output.get('data') or {}
+            for field in data:
+                yield data, field
+        for attachment in (cell.get('attachments') or {}).values():
+            for field in attachment:
+                yield attachment, field
+
+
+def extract(nb, min_size):
+    """ replace values of at least min_size in nb with references, returns {digest: utf-8 bytes} """
+    blobs = {}
+    for mapping, field in _values(nb):
+        value = mapping[field]
+        if not isinstance(value, string_types) or len(value) < min_size or value.startswith(REF_PREFIX):
+            continue
+        data = value.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        blobs[digest] = data
+        mapping[field] = REF_PREFIX + digest
+    return blobs
+
+
+def references(nb):
+    """ the digests nb refers to """
+    return set(
+        mapping[field][len(REF_PREFIX):] for mapping, field in _values(nb)
+        if isinstance(mapping[field], string_types) and mapping[field].startswith(REF_PREFIX))
+
+
+def restore(nb, blobs):
+    """ put the values in {digest: utf-8 bytes} back in place of their references in nb """
+    for mapping, field in _values(nb):
+        value = mapping[field]
+        if isinstance(value, string_types) and value.startswith(REF_PREFIX):
+            mapping[field] = blobs[value[len(REF_PREFIX):]].decode('utf-8')
+
+
+def _read_notebook(bucket, key_name):
+    """ the notebook at key_name, decompressed """
+    k = bucket.new_key(key_name)
+    data = k.get_contents_as_string()
+    return nbformat.reads(decompressing_reader(io.BytesIO(data), k.content_encoding).read().decode('utf-8'), as_version=4)
+
+
+def sweep(bucket, prefix, delimiter='/', min_age=7 * 24 * 60 * 60, dry_run=False, log=None):
+    """
+    delete the blobs under prefix that no notebook or checkpoint below prefix
+    refers to and that are older than min_age seconds, returns their digests
+    """
+    log = log or logging.getLogger(__name__)
+    blob_prefix = prefix + BLOB_DIR + delimiter
+    stored = {}
+    referenced = set()
+    for k in bucket.list(prefix):
+        if k.name.startswith(blob_prefix):
+            stored[k.name[len(blob_prefix):]] = k.last_modified
+        elif k.name.endswith('.ipynb'):
+            # one that can't be read could refer to any of them, so this raises rather than skipping it
+            referenced |= references(_read_notebook(bucket, k.name))
+    cutoff = utcnow() - datetime.timedelta(seconds=min_age)
+    unreferenced = sorted(digest for digest, last_modified in stored.items()
+                          if digest not in referenced and parse_s3_time(last_modified, S3_TIMEFORMAT_BUCKET_LIST) < cutoff)
+    log.info('%d of %d blobs under %s are unreferenced and older than %s', len(unreferenced), len(stored), blob_prefix, cutoff)
+    if dry_run:
+        return unreferenced
+    for i in range(0, len(unreferenced), 1000):
+        result = bucket.delete_keys([blob_prefix + digest for digest in unreferenced[i:i + 1000]], quiet=True)
+        for error in result.errors:
+            log.warning('could not delete %s: %s', error.key, error.message)
+    return unreferenced
+
+
+def main(argv=None):
+    import boto
+
+    parser = argparse.ArgumentParser(description='Delete the s3nb output blobs no notebook refers to any more.')
+    parser.add_argument('uri', help='s3://bucket/prefix/ the notebooks and their blobs are kept under')
+    parser.add_argument('--delimiter', default='/')
+    parser.add_argument('--min-age', type=float, default=7,
+                        help='only delete blobs uploaded at least this many days ago (default 7)')
+    parser.add_argument('--dry-run', action='store_true', help='only log how many blobs would be deleted')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not args.uri.startswith('s3://'):
+        parser.error('expected an s3:// uri')
+    bucket_name, _, prefix = args.uri[5:].partition(args.delimiter)
+    if prefix and not prefix.endswith(args.delimiter):
+        prefix += args.delimiter
+    bucket = boto.connect_s3().get_bucket(bucket_name, validate=False)
+    sweep(bucket, prefix, args.delimiter, args.min_age * 24 * 60 * 60, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
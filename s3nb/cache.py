@@ -0,0 +1,243 @@
+"""
+In-process caches for s3 listings, key metadata and object bodies.
+"""
+from collections import OrderedDict, namedtuple
+import itertools
+import logging
+import threading
+import time
+
+from .invalidation import CLEAR, KEY, PREFIX
+
+
+MISSING = object()
+
+# what a generation counter of a prefix counts invalidations of
+LISTING = 'listing'
+TREE = 'tree'
+
+# the metadata of a cached body, last_modified is in the HEAD/GET header format
+cachedkey = namedtuple('cachedkey', 'name last_modified etag content_encoding size')
+
+
+class TTLCache(object):
+    """ a size-bounded LRU mapping whose entries expire after ttl seconds """
+
+    def __init__(self, ttl, max_entries, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires < self.clock():
+                return default
+            # re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.clock() + self.ttl, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ContentCache(object):
+    """
+    A byte-bounded LRU of object bodies keyed by s3 key.  Entries carry the
+    etag they were read at so callers can revalidate them with a conditional
+    GET instead of downloading them again.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """ returns (cachedkey, data) or None """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._data[key] = entry
+            return entry
+
+    def set(self, k, data):
+        if len(data) > self.max_bytes:
+            self.invalidate(k.name)
+            return
+        entry = (cachedkey(k.name, k.last_modified, k.etag, getattr(k, 'content_encoding', None), len(data)), data)
+        with self._lock:
+            old = self._data.pop(k.name, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._data[k.name] = entry
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                self.size -= len(self._data.pop(key)[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+def ancestors(key, delimiter):
+    """ 'a/b/c.ipynb' -> ['a/b/', 'a/', ''] """
+    parts = key.rstrip(delimiter).split(delimiter)[:-1]
+    prefixes = [delimiter.join(parts[:i]) + delimiter for i in range(len(parts), 0, -1)]
+    return prefixes + ['']
+
+
+class S3MetadataCache(object):
+    """
+    Caches LIST results per prefix, HEAD results per key, directory
+    existence checks per prefix and object bodies per key.  A cached HEAD
+    result of None records that the key does not exist.  Listings of more
+    than max_listing_keys keys are never cached.
+
+    Separately, it remembers when each directory prefix last changed, as
+    worked out from s3 by the contents manager, so that every replica
+    reports the same time for it.  These markers outlive the caches and are
+    only dropped when something below the prefix is invalidated.  A marker
+    or listing worked out while such an invalidation happened is not kept,
+    which callers check by comparing generation() before and after.
+
+    With an invalidation channel, local invalidations are broadcast to the
+    other replicas and theirs are applied here.  Remote invalidations leave
+    cached bodies alone since those are revalidated by etag anyway.
+    """
+
+    def __init__(self, ttl=30, max_entries=1000, delimiter='/', content_max_bytes=0, channel=None, bucket=None,
+                 max_listing_keys=10000):
+        self.delimiter = delimiter
+        self.listings = TTLCache(ttl, max_entries)
+        self.max_listing_keys = max_listing_keys
+        self.heads = TTLCache(ttl, max_entries)
+        self.dirs = TTLCache(ttl, max_entries)
+        self.contents = ContentCache(content_max_bytes)
+        self.modified = TTLCache(24 * 60 * 60, max(max_entries, 10000))
+        self._generations = TTLCache(24 * 60 * 60, max(max_entries, 10000))
+        self._counter = itertools.count(1)
+        self._generation_lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+        self.bucket = bucket
+        self.channel = channel
+        if channel is not None:
+            channel.subscribe(self._remote_invalidation)
+
+    def _metadata_caches(self, contents):
+        caches = (self.heads, self.listings, self.dirs)
+        return caches + (self.contents,) if contents else caches
+
+    def _drop_key(self, key, contents=True):
+        self.heads.invalidate(key)
+        if contents:
+            self.contents.invalidate(key)
+        for prefix in ancestors(key, self.delimiter):
+            self.listings.invalidate(prefix)
+            self.dirs.invalidate(prefix)
+            with self._generation_lock:
+                self.modified.invalidate(prefix)
+                self._generations.set((LISTING, prefix), next(self._counter))
+
+    def _drop_prefix(self, prefix, contents=True):
+        for cache in self._metadata_caches(contents):
+            cache.invalidate_prefix(prefix)
+        with self._generation_lock:
+            self.modified.invalidate_prefix(prefix)
+            self._generations.set((TREE, prefix), next(self._counter))
+        self._drop_key(prefix, contents)
+
+    def _publish(self, kind, name):
+        if self.channel is None:
+            return
+        try:
+            self.channel.publish(self.bucket, kind, name)
+        except Exception:
+            self.log.exception('failed to publish invalidation of %s %s', kind, name)
+
+    def _remote_invalidation(self, bucket, kind, name):
+        if kind == CLEAR:
+            self.clear(contents=False)
+        elif bucket != self.bucket:
+            return
+        elif kind == KEY:
+            self._drop_key(name, contents=False)
+        elif kind == PREFIX:
+            self._drop_prefix(name, contents=False)
+
+    def generation(self, prefix):
+        """ changes whenever anything at or below prefix is invalidated """
+        # a write changes the listings of the prefixes above it, dropping a prefix everything below it
+        return (self._generations.get((LISTING, prefix), 0),) + tuple(
+            self._generations.get((TREE, p), 0) for p in [prefix] + ancestors(prefix, self.delimiter))
+
+    def last_modified(self, prefix):
+        """ when prefix last changed, None if that isn't known """
+        return self.modified.get(prefix, None)
+
+    def set_last_modified(self, prefix, when, generation):
+        """ record when prefix last changed, as worked out at generation """
+        with self._generation_lock:
+            if self.generation(prefix) == generation:
+                self.modified.set(prefix, when)
+
+    def invalidate_key(self, key):
+        """ drop everything a write to key could have changed """
+        self._drop_key(key)
+        self._publish(KEY, key)
+
+    def invalidate_prefix(self, prefix):
+        """ drop everything at or below prefix, plus the listings above it """
+        self._drop_prefix(prefix)
+        self._publish(PREFIX, prefix)
+
+    def clear(self, contents=True):
+        for cache in self._metadata_caches(contents):
+            cache.clear()
+        with self._generation_lock:
+            self.modified.clear()
+            self._generations.set((TREE, ''), next(self._counter))
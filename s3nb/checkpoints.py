@@ -0,0 +1,106 @@
+"""
+Checkpoints stored in s3 alongside their notebooks, for IPython 3.x+.
+
+c.S3ContentsManager.checkpoints_class = 's3nb.S3Checkpoints'
+"""
+import datetime
+import posixpath
+import re
+
+from IPython.html.services.contents.checkpoints import Checkpoints
+from IPython.utils.traitlets import Integer, Unicode
+
+from .metrics import traced
+from .timestamps import S3_TIMEFORMAT_BUCKET_LIST, parse_s3_time
+
+
+CHECKPOINT_ID_FORMAT = '%Y%m%dT%H%M%S%f'
+CHECKPOINT_ID_RE = r'\d{8}T\d{12}'
+
+
+class S3Checkpoints(Checkpoints):
+    """
+    Keeps up to max_checkpoints copies of a file as
+    <dir>/<checkpoint_dir>/<name>-<checkpoint_id><ext> in the contents
+    manager's bucket.  Checkpoints are created and restored with server-side
+    copies, so their bytes never pass through the notebook server.
+    """
+    checkpoint_dir = Unicode(u'.ipynb_checkpoints', config=True)
+    max_checkpoints = Integer(1, config=True)
+
+    def _split(self, path):
+        path = path.strip('/')
+        directory, name = posixpath.split(path)
+        basename, ext = posixpath.splitext(name)
+        return directory, basename, ext
+
+    def _checkpoint_prefix(self, path):
+        directory, basename, _ = self._split(path)
+        return self.parent._path_to_s3_key(posixpath.join(directory, self.checkpoint_dir, basename + '-'))
+
+    def _checkpoint_key(self, checkpoint_id, path):
+        _, _, ext = self._split(path)
+        return self._checkpoint_prefix(path) + checkpoint_id + ext
+
+    def _checkpoint_model(self, checkpoint_id, k):
+        return {
+            'id': checkpoint_id,
+            'last_modified': parse_s3_time(k.last_modified, S3_TIMEFORMAT_BUCKET_LIST),
+        }
+
+    def _copy(self, dst_key, src_key):
+        cm = self.parent
+        self.log.debug('copying checkpoint in bucket: %s from %s to %s', cm.bucket.name, src_key, dst_key)
+        try:
+            k = cm._s3(cm.bucket.copy_key, dst_key, cm.bucket.name, src_key)
+        finally:
+            cm.s3_cache.invalidate_key(dst_key)
+        return k
+
+    @traced('create_checkpoint')
+    def create_checkpoint(self, contents_mgr, path):
+        checkpoint_id = datetime.datetime.utcnow().strftime(CHECKPOINT_ID_FORMAT)
+        # the checkpoint is copied from s3, so a save still being written behind has to get there first
+        contents_mgr._flush_pending(contents_mgr._path_to_s3_key(path))
+        k = self._copy(self._checkpoint_key(checkpoint_id, path), contents_mgr._path_to_s3_key(path))
+        for old in self.list_checkpoints(path)[:-max(self.max_checkpoints, 1)]:
+            self.delete_checkpoint(old['id'], path)
+        return self._checkpoint_model(checkpoint_id, k)
+
+    @traced('restore_checkpoint')
+    def restore_checkpoint(self, contents_mgr, checkpoint_id, path):
+        self.log.info('Restoring %s from checkpoint %s', path, checkpoint_id)
+        # or a pending save would overwrite the restored notebook
+        key = contents_mgr._path_to_s3_key(path)
+        contents_mgr._flush_pending(key)
+        k = self._copy(key, self._checkpoint_key(checkpoint_id, path))
+        contents_mgr._update_manifest(key, contents_mgr._copied_entry(key, k))
+
+    @traced('rename_checkpoint')
+    def rename_checkpoint(self, checkpoint_id, old_path, new_path):
+        old_key = self._checkpoint_key(checkpoint_id, old_path)
+        self._copy(self._checkpoint_key(checkpoint_id, new_path), old_key)
+        self._delete(old_key)
+
+    @traced('delete_checkpoint')
+    def delete_checkpoint(self, checkpoint_id, path):
+        self._delete(self._checkpoint_key(checkpoint_id, path))
+
+    def _delete(self, key):
+        cm = self.parent
+        self.log.debug('removing checkpoint in bucket: %s : %s', cm.bucket.name, key)
+        cm._s3(cm.bucket.delete_key, key)
+        cm.s3_cache.invalidate_key(key)
+
+    @traced('list_checkpoints')
+    def list_checkpoints(self, path):
+        """ checkpoints of path, oldest first """
+        _, _, ext = self._split(path)
+        prefix = self._checkpoint_prefix(path)
+        pattern = re.compile(re.escape(prefix) + '(' + CHECKPOINT_ID_RE + ')' + re.escape(ext) + '$')
+        checkpoints = []
+        for k in self.parent._iter_keys(prefix):
+            match = pattern.match(k.name)
+            if match:
+                checkpoints.append(self._checkpoint_model(match.group(1), k))
+        return sorted(checkpoints, key=lambda c: c['id'])
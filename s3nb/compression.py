@@ -0,0 +1,47 @@
+"""
+Codecs for compressing notebooks at rest in s3.
+
+The codec used is recorded as the key's Content-Encoding, keys without one
+are read as-is.
+"""
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODECS = ('gzip', 'zstd')
+
+
+def check_codec(codec):
+    if codec is None:
+        return
+    if codec not in CODECS:
+        raise ValueError("Unknown compression codec '{}', expected one of {}".format(codec, CODECS))
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+
+def compress(data, codec):
+    if codec is None:
+        return data
+    check_codec(codec)
+    if codec == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def decompressing_reader(fp, content_encoding):
+    """ wrap fp so reads return the decoded body of a key with content_encoding """
+    if not content_encoding or content_encoding == 'identity':
+        return fp
+    check_codec(content_encoding)
+    if content_encoding == 'gzip':
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    return zstandard.ZstdDecompressor().stream_reader(fp)
@@ -0,0 +1,130 @@
+"""
+A process-wide pool of s3 connections shared by every manager instance.
+
+boto connections are not safe to share between threads, so each thread
+doing s3 work leases its own keep-alive connection from the pool and gives
+it back when the thread exits.  Buckets handed out by the pool resolve
+their connection per call, so keys and multipart uploads created from them
+always use the calling thread's connection.
+"""
+from collections import deque
+import threading
+import time
+
+import boto
+from boto.s3.bucket import Bucket
+
+from .metrics import instrument
+from .scheduler import SCHEDULER
+
+
+class _Lease(object):
+    """ a thread's hold on a connection, returned to the pool when the thread goes away """
+
+    def __init__(self, pool, connection, created):
+        self.pool = pool
+        self.connection = connection
+        self.created = created
+
+    def __del__(self):
+        if self.connection is None:
+            return
+        try:
+            self.pool._release(self.connection, self.created)
+        except Exception:
+            pass
+
+
+class S3ConnectionPool(object):
+    """
+    Hands each thread a boto S3Connection, keeping up to size idle
+    connections around for reuse.  Connections older than max_age seconds
+    are closed and replaced on their next use, so long-lived servers pick up
+    DNS and credential changes.  timeout, if given, is the socket timeout of
+    every connection, which bounds each request rather than whole transfers.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, size=10, max_age=300, timeout=None, clock=time.time, **connect_kwargs):
+        self.size = size
+        self.max_age = max_age
+        self.timeout = timeout
+        self.clock = clock
+        self.connect_kwargs = connect_kwargs
+        self.created = 0
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def shared(cls, size=10, max_age=300, timeout=None, **connect_kwargs):
+        """ the pool for connect_kwargs, created on first use """
+        key = tuple(sorted(connect_kwargs.items()))
+        with cls._shared_lock:
+            pool = cls._shared.get(key)
+            if pool is None:
+                pool = cls._shared[key] = cls(size=size, max_age=max_age, timeout=timeout, **connect_kwargs)
+            return pool
+
+    def _healthy(self, created):
+        return self.max_age <= 0 or self.clock() - created < self.max_age
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                connection, created = self._idle.pop()
+                if self._healthy(created):
+                    return connection, created
+                self._close(connection)
+            self.created += 1
+        connection = boto.connect_s3(**self.connect_kwargs)
+        if self.timeout:
+            connection.http_connection_kwargs['timeout'] = self.timeout
+        # each throttled retry is recorded as a request of its own
+        return SCHEDULER.schedule(instrument(connection)), self.clock()
+
+    def _release(self, connection, created):
+        with self._lock:
+            if len(self._idle) < self.size and self._healthy(created):
+                self._idle.append((connection, created))
+                return
+        self._close(connection)
+
+    def connection(self):
+        """ the calling thread's connection """
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None and not self._healthy(lease.created):
+            self._close(lease.connection)
+            lease.connection = lease = None
+        if lease is None:
+            lease = self._local.lease = _Lease(self, *self._acquire())
+        return lease.connection
+
+    def bucket(self, name):
+        """ a bucket handle that needs no validation request """
+        return PooledBucket(self, name)
+
+
+class PooledBucket(Bucket):
+    """ a Bucket whose connection is the calling thread's connection from pool """
+
+    def __init__(self, pool, name=None):
+        self.pool = pool
+        super(PooledBucket, self).__init__(name=name)
+
+    @property
+    def connection(self):
+        return self.pool.connection()
+
+    @connection.setter
+    def connection(self, value):
+        # Bucket.__init__ assigns the connection, ours is always looked up
+        pass
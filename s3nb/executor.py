@@ -0,0 +1,107 @@
+"""
+A bounded thread pool for running blocking boto calls off the tornado IOLoop.
+"""
+from concurrent.futures import Future, TimeoutError
+import heapq
+import itertools
+import threading
+
+from .metrics import bind, current_span
+from .scheduler import operation_priority
+
+
+class S3Executor(object):
+    """
+    Runs s3 calls on at most max_workers threads.  call() waits at most
+    timeout seconds for a thread to start the call, and then for as long as
+    it runs, submit() hands back a future that tornado coroutines can yield.
+    Calls made from a pool thread run inline so an operation running on the
+    pool can issue its own s3 calls without deadlocking.  max_workers=0 runs everything on the calling thread.
+    Queued calls start in the priority order of the operations that made
+    them, so opening a notebook doesn't wait behind autosaves and listings.
+    """
+
+    def __init__(self, max_workers=8, timeout=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._local = threading.local()
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._idle = 0
+        self._shutdown = False
+
+    def _in_pool(self):
+        return getattr(self._local, 'in_pool', False)
+
+    def _worker(self):
+        self._local.in_pool = True
+        while True:
+            with self._cond:
+                while not self._queue and not self._shutdown:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                if not self._queue:
+                    return
+                _, _, future, func, args, kwargs = heapq.heappop(self._queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, func, *args, **kwargs):
+        return self.submit_as(operation_priority(current_span()), func, *args, **kwargs)
+
+    def submit_as(self, priority, func, *args, **kwargs):
+        """ submit func to start before anything queued with a higher priority value """
+        if self.max_workers <= 0:
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot submit s3 calls after shutdown')
+            heapq.heappush(self._queue, (priority, next(self._seq),
+                                         future, bind(func), args, kwargs))
+            if self._idle < len(self._queue) and len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, name='s3nb-executor-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return future
+
+    def call(self, func, *args, **kwargs):
+        if self.max_workers <= 0 or self._in_pool():
+            return func(*args, **kwargs)
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                # it never started, so nothing was sent to s3
+                raise
+        # abandoning a write that is under way would leave us not knowing what s3 holds,
+        # each of its requests is bounded by the connections' socket timeout instead
+        return future.result()
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+__all__ = ['S3Executor', 'TimeoutError']
@@ -0,0 +1,68 @@
+"""
+Serve /files/ straight from s3 in ranges instead of through the contents model.
+
+c.NotebookApp.server_extensions = ['s3nb.files']
+
+IPython's own /files/ handler reads the whole file into a contents model,
+which S3ContentsManager cuts short at s3_file_preview_size.  This one
+streams the key to the client s3_multipart_chunksize bytes at a time, so
+downloads of any size are complete and hold one chunk in memory.
+Notebooks are still served by IPython's handler.
+"""
+import mimetypes
+
+from tornado import gen, web
+
+from IPython.html.files.handlers import FilesHandler
+from IPython.html.utils import url_path_join
+
+from .handlers import add_handlers_first
+from .scheduler import NORMAL
+
+
+class S3FilesHandler(FilesHandler):
+    """ FilesHandler for an S3ContentsManager """
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, path):
+        cm = self.contents_manager
+        path = path.strip('/')
+        if path.endswith('.ipynb'):
+            # notebooks may be compressed or hold blobs, get(type='file') serves them decompressed and whole
+            super(S3FilesHandler, self).get(path)
+            return
+        if cm.is_hidden(path):
+            self.log.info("Refusing to serve hidden file, via 404 Error")
+            raise web.HTTPError(404)
+
+        k = yield cm.s3_executor.submit_as(NORMAL, cm._get_key, cm._path_to_s3_key(path), False)
+        if not k or k.name.endswith(cm.s3_key_delimiter):
+            raise web.HTTPError(404)
+        name = path.rsplit('/', 1)[-1]
+
+        if self.get_argument("download", False):
+            self.set_header('Content-Disposition', 'attachment; filename="%s"' % name)
+        self.set_header('Content-Type', mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        self.set_header('Content-Length', k.size)
+
+        chunk_size = cm.s3_transfer.part_size
+        for start in range(0, k.size, chunk_size):
+            # every range has to come from the version we started with
+            chunk = yield cm.s3_executor.submit_as(
+                NORMAL, cm.s3_transfer.read_range, cm.bucket, k.name,
+                start, min(start + chunk_size, k.size) - 1, k.etag)
+            self.write(chunk)
+            # wait for the client to take it before fetching the next one
+            yield self.flush()
+
+
+def load_jupyter_server_extension(nbapp):
+    from .ipy3 import S3ContentsManager
+    if not isinstance(nbapp.contents_manager, S3ContentsManager):
+        nbapp.log.warning('s3nb.files only serves files for S3ContentsManager, leaving /files/ as it is')
+        return
+    web_app = nbapp.web_app
+    route = url_path_join(web_app.settings['base_url'], r'/files/(.*)')
+    add_handlers_first(web_app, [(route, S3FilesHandler)])
+    nbapp.log.info('Streaming files from s3 at %s', route)
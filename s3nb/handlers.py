@@ -0,0 +1,113 @@
+"""
+Serve /api/contents without blocking the IOLoop on s3.
+
+c.NotebookApp.server_extensions = ['s3nb.handlers']
+
+IPython's contents handlers call the contents manager on the IOLoop, so
+every s3 request S3ContentsManager makes holds up the whole server.  These
+handlers run each call on the manager's s3 executor and yield its future:
+opens go through get_async ahead of listings, saves through save_async
+behind them, and everything else at normal priority.
+"""
+from tornado import gen, web
+
+from IPython.html.base.handlers import json_errors, path_regex
+from IPython.html.services.contents.handlers import (
+    CheckpointsHandler, ContentsHandler, ModifyCheckpointsHandler, _checkpoint_id_regex,
+)
+from IPython.html.utils import url_path_join
+
+from .scheduler import NORMAL
+
+
+def add_handlers_first(web_app, handlers):
+    """ add handlers so they are matched before IPython's own for the same routes """
+    web_app.add_handlers('.*$', handlers)
+    router = getattr(web_app, 'default_router', None)
+    if router is not None:
+        # tornado 4.5+ adds host rules after IPython's, which would match first
+        router.rules.insert(0, router.rules.pop(-2))
+
+
+class AsyncContents(object):
+    """ a contents manager whose methods return futures of calls run on its s3 executor """
+
+    def __init__(self, contents_manager):
+        self._cm = contents_manager
+
+    def get(self, path, content=True, type=None, format=None):
+        return self._cm.get_async(path, content=content, type=type, format=format)
+
+    def save(self, model, path):
+        return self._cm.save_async(model, path)
+
+    def __getattr__(self, name):
+        attr = getattr(self._cm, name)
+        if not callable(attr):
+            return attr
+
+        def submit(*args, **kwargs):
+            return self._cm.s3_executor.submit_as(NORMAL, attr, *args, **kwargs)
+        return submit
+
+
+class AsyncContentsMixin(object):
+
+    @property
+    def contents_manager(self):
+        return AsyncContents(self.settings['contents_manager'])
+
+
+class S3ContentsHandler(AsyncContentsMixin, ContentsHandler):
+
+    @web.authenticated
+    @json_errors
+    @gen.coroutine
+    def post(self, path=''):
+        """ like ContentsHandler.post, which checks what path is without yielding """
+        cm = self.contents_manager
+
+        file_exists = yield cm.file_exists(path)
+        if file_exists:
+            raise web.HTTPError(400, "Cannot POST to files, use PUT instead.")
+
+        dir_exists = yield cm.dir_exists(path)
+        if not dir_exists:
+            raise web.HTTPError(404, "No such directory: %s" % path)
+
+        model = self.get_json_body()
+
+        if model is not None:
+            copy_from = model.get('copy_from')
+            ext = model.get('ext', '')
+            type = model.get('type', '')
+            if copy_from:
+                yield self._copy(copy_from, path)
+            else:
+                yield self._new_untitled(path, type=type, ext=ext)
+        else:
+            yield self._new_untitled(path)
+
+
+class S3CheckpointsHandler(AsyncContentsMixin, CheckpointsHandler):
+    pass
+
+
+class S3ModifyCheckpointsHandler(AsyncContentsMixin, ModifyCheckpointsHandler):
+    pass
+
+
+def load_jupyter_server_extension(nbapp):
+    from .ipy3 import S3ContentsManager
+    if not isinstance(nbapp.contents_manager, S3ContentsManager):
+        nbapp.log.warning('s3nb.handlers only serves S3ContentsManager, leaving /api/contents as it is')
+        return
+    web_app = nbapp.web_app
+    base_url = web_app.settings['base_url']
+    add_handlers_first(web_app, [
+        (url_path_join(base_url, r'/api/contents%s/checkpoints' % path_regex), S3CheckpointsHandler),
+        (url_path_join(base_url, r'/api/contents%s/checkpoints/%s' % (path_regex, _checkpoint_id_regex)),
+            S3ModifyCheckpointsHandler),
+        (url_path_join(base_url, r'/api/contents%s' % path_regex), S3ContentsHandler),
+    ])
+    nbapp.log.info('Serving contents from s3 off the IOLoop at %s', url_path_join(base_url, '/api/contents'))
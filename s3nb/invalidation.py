@@ -0,0 +1,139 @@
+"""
+Channels for telling other notebook servers which cached s3 keys and
+prefixes a write has made stale.
+
+c.S3ContentsManager.s3_invalidation_channel = 'file'
+c.S3ContentsManager.s3_invalidation_channel_kwargs = {'path': '/shared/s3nb-invalidations.log'}
+
+Any other value is imported as an InvalidationChannel subclass, which is
+how an external broker (redis, sns, ...) can be plugged in.
+"""
+import io
+import json
+import logging
+import os
+import threading
+import uuid
+
+from IPython.utils.importstring import import_item
+
+
+KEY = 'key'
+PREFIX = 'prefix'
+CLEAR = 'clear'
+
+
+class InvalidationChannel(object):
+    """
+    Broadcasts invalidations to every other replica and delivers theirs.
+    Subclasses implement publish() and arrange for the subscribed callback
+    to be called as callback(bucket, kind, name) for each message from
+    another replica, where kind is KEY, PREFIX or CLEAR.
+    """
+
+    def __init__(self, replica_id=None, log=None):
+        self.replica_id = replica_id or uuid.uuid4().hex
+        self.log = log or logging.getLogger(__name__)
+        self.callbacks = []
+
+    def publish(self, bucket, kind, name):
+        pass
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def deliver(self, bucket, kind, name):
+        for callback in self.callbacks:
+            try:
+                callback(bucket, kind, name)
+            except Exception:
+                self.log.exception('invalidation callback failed for %s %s %s', bucket, kind, name)
+
+    def close(self):
+        pass
+
+
+class FileInvalidationChannel(InvalidationChannel):
+    """
+    Replicas on one host, or sharing a filesystem, append invalidations to a
+    common log file and tail it every poll_interval seconds.  Once the file
+    grows past max_size the next writer truncates it, and readers that see
+    it shrink drop their whole cache since they may have missed messages.
+    """
+
+    def __init__(self, path, poll_interval=1.0, max_size=16 * 1024 * 1024, **kwargs):
+        super(FileInvalidationChannel, self).__init__(**kwargs)
+        self.path = os.path.expanduser(path)
+        self.poll_interval = poll_interval
+        self.max_size = max_size
+        # start from the current end, older messages predate our cache
+        self.offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish(self, bucket, kind, name):
+        line = json.dumps({'replica': self.replica_id, 'bucket': bucket, 'kind': kind, 'name': name}) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > self.max_size:
+                os.ftruncate(fd, 0)
+            # a single O_APPEND write keeps lines from different writers whole
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def subscribe(self, callback):
+        super(FileInvalidationChannel, self).subscribe(callback)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='s3nb-invalidations')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                self.log.exception('failed to read invalidations from %s', self.path)
+
+    def poll(self):
+        """ deliver messages appended since the last poll """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self.offset:
+            self.offset = 0
+            self.deliver(None, CLEAR, None)
+        if size == self.offset:
+            return
+        with io.open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        # leave a partially written last line for the next poll
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        for line in data.splitlines():
+            try:
+                message = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if message.get('replica') != self.replica_id:
+                self.deliver(message.get('bucket'), message.get('kind'), message.get('name'))
+
+    def close(self):
+        self._stopped.set()
+
+
+CHANNELS = {
+    'file': FileInvalidationChannel,
+}
+
+
+def make_channel(name, **kwargs):
+    if name is None:
+        return None
+    cls = CHANNELS.get(name)
+    if cls is None:
+        cls = import_item(name)
+    return cls(**kwargs)
@@ -8,6 +8,7 @@ c.NotebookApp.notebook_manager_class = 's3nb.S3NotebookManager'
 c.NotebookApp.log_level = 'DEBUG'
 c.S3NotebookManager.s3_base_uri = 's3://bucket/notebook/prefix/'
 """
+from collections import namedtuple
 import datetime
 import tempfile
 from os.path import join, splitext
@@ -18,12 +19,17 @@ from tornado import web
 from IPython.html.services.notebooks.nbmanager import NotebookManager
 from IPython.nbformat import current
 from IPython.utils.traitlets import Unicode
-from IPython.utils import tz
 
+from .connection import S3ConnectionPool
+from .metrics import METRICS, traced
+from .scheduler import SCHEDULER, THROTTLED_MESSAGE, is_throttled
+from .summary import summarize
+from .timestamps import S3_TIMEFORMAT_BUCKET_LIST, S3_TIMEFORMAT_GET_KEY, parse_s3_time
+from .transfer import UploadKey
 
-# s3 return different time formats in different situations apparently
-S3_TIMEFORMAT_GET_KEY = '%a, %d %b %Y %H:%M:%S GMT'
-S3_TIMEFORMAT_BUCKET_LIST = '%Y-%m-%dT%H:%M:%S.000Z'
+
+# stands in for a HEAD of a key we just wrote, last_modified is in S3_TIMEFORMAT_GET_KEY
+savedkey = namedtuple('savedkey', 'name last_modified etag')
 
 
 class S3NotebookManager(NotebookManager):
@@ -38,7 +44,6 @@ class S3NotebookManager(NotebookManager):
         return uri[5:].split(delimiter, 1)
 
     def _s3_key_dir_to_model(self, key):
-        self.log.debug("_s3_key_dir_to_model: {}: {}".format(key, key.name))
         model = {
             'name': key.name.rsplit(self.s3_key_delimiter, 2)[-2],
             'path': key.name,
@@ -46,20 +51,16 @@ class S3NotebookManager(NotebookManager):
             'created': None, # key.last_modified,
             'type': 'directory',
         }
-        self.log.debug("_s3_key_dir_to_model: {}: {}".format(key.name, model))
         return model
 
     def _s3_key_notebook_to_model(self, key, timeformat):
-        self.log.debug("_s3_key_notebook_to_model: {}: {}".format(key, key.name))
         model = {
             'name': key.name.rsplit(self.s3_key_delimiter, 1)[-1],
             'path': key.name,
-            'last_modified': datetime.datetime.strptime(
-                key.last_modified, timeformat).replace(tzinfo=tz.UTC),
+            'last_modified': parse_s3_time(key.last_modified, timeformat),
             'created': None,
             'type': 'notebook',
         }
-        self.log.debug("_s3_key_notebook_to_model: {}: {}".format(key.name, model))
         return model
 
     def _notebook_s3_key_string(self, path, name):
@@ -72,7 +73,7 @@ class S3NotebookManager(NotebookManager):
 
     def _notebook_s3_key(self, path, name):
         key = self._notebook_s3_key_string(path, name)
-        self.log.debug('_notebook_s3_key: looking in bucket:{} for:{}'.format(self.bucket.name, key))
+        self.log.debug('_notebook_s3_key: looking in bucket:%s for:%s', self.bucket.name, key)
         return self.bucket.get_key(key)
 
     def __init__(self, **kwargs):
@@ -84,92 +85,119 @@ class S3NotebookManager(NotebookManager):
         # ensure prefix ends with the delimiter
         if not self.s3_prefix.endswith(self.s3_key_delimiter):
             self.s3_prefix += self.s3_key_delimiter
-        self.s3_connection = boto.connect_s3()
-        self.bucket = self.s3_connection.get_bucket(self.s3_bucket)
+        self.s3_spool_max_size = config.get('s3_spool_max_size', 32 * 1024 * 1024)
+        # connections are shared process-wide, the bucket handle is not validated up front
+        self.s3_connection_pool = S3ConnectionPool.shared(
+            size=config.get('s3_connection_pool_size', 10),
+            max_age=config.get('s3_connection_max_age', 300))
+        self.bucket = self.s3_connection_pool.bucket(self.s3_bucket)
+        SCHEDULER.configure(
+            read_rate=config.get('s3_rate_limit_reads', 5500),
+            write_rate=config.get('s3_rate_limit_writes', 3500),
+            prefix_depth=config.get('s3_rate_limit_prefix_depth', 1),
+            delimiter=self.s3_key_delimiter,
+            retries=config.get('s3_throttle_retries', 8),
+            backoff_base=config.get('s3_backoff_base', 0.05),
+            backoff_max=config.get('s3_backoff_max', 20.0))
+        for tracer in config.get('s3_tracers', []):
+            METRICS.add_tracer(tracer)
+
+    def _spool(self):
+        return tempfile.SpooledTemporaryFile(max_size=self.s3_spool_max_size)
 
     def info_string(self):
         return "Serving notebooks from {}".format(self.s3_base_uri)
 
     def path_exists(self, path):
-        self.log.debug('path_exists: {}'.format(locals()))
+        self.log.debug('path_exists: %s', path)
         return True
 
     def is_hidden(self, path):
-        self.log.debug('is_hidden: {}'.format(locals()))
+        self.log.debug('is_hidden: %s', path)
         return False
 
+    @traced('list_dirs')
     def list_dirs(self, path):
-        self.log.debug('list_dirs: {}'.format(locals()))
+        self.log.debug('list_dirs: %s', path)
         key = self.s3_prefix + path.strip(self.s3_key_delimiter)
         # append delimiter if path is non-empty to avoid s3://bucket//
         if path != '':
             key += self.s3_key_delimiter
-        self.log.debug('list_dirs: looking in bucket:{} under:{}'.format(self.bucket.name, key))
+        self.log.debug('list_dirs: looking in bucket:%s under:%s', self.bucket.name, key)
         notebooks = []
         for k in self.bucket.list(key, self.s3_key_delimiter):
             if k.name.endswith(self.s3_key_delimiter):
                 notebooks.append(self._s3_key_dir_to_model(k))
-                self.log.debug('list_dirs: found {}'.format(k.name))
         return notebooks
 
+    @traced('list_notebooks')
     def list_notebooks(self, path=''):
-        self.log.debug('list_notebooks: {}'.format(locals()))
+        self.log.debug('list_notebooks: %s', path)
         key = self.s3_prefix + path.strip(self.s3_key_delimiter)
         # append delimiter if path is non-empty to avoid s3://bucket//
         if path != '':
             key += self.s3_key_delimiter
-        self.log.debug('list_notebooks: looking in bucket:{} under:{}'.format(self.bucket.name, key))
+        self.log.debug('list_notebooks: looking in bucket:%s under:%s', self.bucket.name, key)
         notebooks = []
         for k in self.bucket.list(key, self.s3_key_delimiter):
             if k.name.endswith(self.filename_ext):
                 notebooks.append(self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST))
-                self.log.debug('list_notebooks: found {}'.format(k.name))
         return notebooks
 
+    @traced('notebook_exists')
     def notebook_exists(self, name, path=''):
-        self.log.debug('notebook_exists: {}'.format(locals()))
+        self.log.debug('notebook_exists: %s %s', path, name)
         k = self._notebook_s3_key(path, name)
         return k is not None and not k.name.endswith(self.s3_key_delimiter)
 
+    @traced('get_notebook')
     def get_notebook(self, name, path='', content=True):
-        self.log.debug('get_notebook: {}'.format(locals()))
+        self.log.debug('get_notebook: %s %s content=%s', path, name, content)
         k = self._notebook_s3_key(path, name)
         model = self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_GET_KEY)
         if content:
             try:
-                with tempfile.NamedTemporaryFile() as f:
+                with self._spool() as f:
                     k.get_file(f)
                     f.seek(0)
-                    nb = current.read(f, u'json')
+                    nb = current.reads(f.read().decode('utf-8'), u'json')
             except Exception as e:
-                raise web.HTTPError(400, u"Unreadable Notebook: %s %s" % (os_path, e))
+                if is_throttled(e):
+                    raise web.HTTPError(503, THROTTLED_MESSAGE)
+                raise web.HTTPError(400, u"Unreadable Notebook: %s %s" % (k.name, e))
             self.mark_trusted_cells(nb, name, path)
             model['content'] = nb
         return model
 
+    @traced('save_notebook')
     def save_notebook(self, model, name, path=''):
-        self.log.debug('save_notebook: {}'.format(locals()))
+        self.log.debug('save_notebook: %s %s %s', path, name, summarize(model))
         if 'content' not in model:
             raise web.HTTPError(400, u'No notebook JSON data provided')
 
-        k = boto.s3.key.Key(self.bucket)
+        k = UploadKey(self.bucket)
         k.key = self._notebook_s3_key_string(path, name)
 
         nb = current.to_notebook_json(model['content'])
         self.check_and_sign(nb, name, path)
 
         try:
-            with tempfile.NamedTemporaryFile() as f:
-                current.write(nb, f, u'json')
+            with self._spool() as f:
+                f.write(current.writes(nb, u'json').encode('utf-8'))
                 f.seek(0)
                 k.set_contents_from_file(f)
         except Exception as e:
+            if is_throttled(e):
+                raise web.HTTPError(503, THROTTLED_MESSAGE)
             raise web.HTTPError(400, u"Unexpected Error Writing Notebook: %s %s %s" % (path, name, e))
 
-        return self.get_notebook(name, path, content=False)
+        # build the returned model from the PUT rather than another HEAD
+        saved = savedkey(k.key, k.last_modified or datetime.datetime.utcnow().strftime(S3_TIMEFORMAT_GET_KEY), k.etag)
+        return self._s3_key_notebook_to_model(saved, timeformat=S3_TIMEFORMAT_GET_KEY)
 
+    @traced('update_notebook')
     def update_notebook(self, model, name, path=''):
-        self.log.debug('update_notebook: {}'.format(locals()))
+        self.log.debug('update_notebook: %s %s %s', path, name, summarize(model))
 
         # support updating just name or path even though there doesn't seem to be a way to do this via the UI
         new_name = model.get('name', name)
@@ -177,40 +205,44 @@ class S3NotebookManager(NotebookManager):
         if path != new_path or name != new_name:
             src_key = self._notebook_s3_key_string(path, name)
             dst_key = self._notebook_s3_key_string(new_path, new_name)
-            self.log.debug('copying notebook in bucket: {} from {} to {}'.format(self.bucket.name, src_key, dst_key))
+            self.log.debug('copying notebook in bucket: %s from %s to %s', self.bucket.name, src_key, dst_key)
             if self.bucket.get_key(dst_key):
                 raise web.HTTPError(409, u'Notebook with name already exists: %s' % src_key)
-            self.bucket.copy_key(dst_key, self.bucket.name, src_key)
-            self.log.debug('removing notebook in bucket: {} : {}'.format(self.bucket.name, src_key))
+            # the copy result carries the new key's etag and last_modified
+            k = self.bucket.copy_key(dst_key, self.bucket.name, src_key)
+            self.log.debug('removing notebook in bucket: %s : %s', self.bucket.name, src_key)
             self.bucket.delete_key(src_key)
+            return self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)
 
         return self.get_notebook(new_name, new_path, content=False)
 
+    @traced('delete_notebook')
     def delete_notebook(self, name, path=''):
-        self.log.debug('delete_notebook: {}'.format(locals()))
+        self.log.debug('delete_notebook: %s %s', path, name)
 
         key = self._notebook_s3_key_string(path, name)
-        self.log.debug('removing notebook in bucket: {} : {}'.format(self.bucket.name, key))
+        self.log.debug('removing notebook in bucket: %s : %s', self.bucket.name, key)
         self.bucket.delete_key(key)
 
+    @traced('copy_notebook')
     def copy_notebook(self, from_name, to_name=None, path=''):
         """
         Copy an existing notebook and return its new model.
 
         If to_name not specified, increment from_name-Copy#.ipynb.
         """
-        self.log.debug('copy_notebook: {}'.format(locals()))
+        self.log.debug('copy_notebook: %s %s to %s', path, from_name, to_name)
         if to_name is None:
             from_name_root, _ = splitext(from_name)
             to_name = self.increment_filename(from_name_root + '-Copy', path)
 
-        model = self.get_notebook(from_name, path)
-        model['name'] = to_name
-
-        self.log.debug('copying notebook from {} to {} with path {}'.format(from_name, to_name, path))
-        self.create_notebook(model, path)
+        src_key = self._notebook_s3_key_string(path, from_name)
+        dst_key = self._notebook_s3_key_string(path, to_name)
+        self.log.debug('copying notebook from %s to %s with path %s', from_name, to_name, path)
+        # server-side copy, the result carries the new key's last_modified
+        k = self.bucket.copy_key(dst_key, self.bucket.name, src_key)
 
-        return model
+        return self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)
 
     # Checkpoint methods
     checkpoint_dir = Unicode(u'ipynb_checkpoints', config=True)
@@ -245,27 +277,36 @@ class S3NotebookManager(NotebookManager):
 
         return checkpoint_model
 
+    @traced('create_checkpoint')
     def create_checkpoint(self, name, path=''):
         checkpoint_id = u'checkpoint'
         checkpoint_name = self.get_checkpoint_name(checkpoint_id, name)
         checkpoint_path = self.get_checkpoint_path(path)
 
-        self.log.debug('creating checkpoint for notebook {}'.format(name))
-        model = self.get_notebook(name, path)
-        model['name'] = checkpoint_name
-        self.create_notebook(model, checkpoint_path)
+        self.log.debug('creating checkpoint for notebook %s', name)
+        # copy server-side, the copy result carries the checkpoint's last_modified
+        k = self.bucket.copy_key(
+            self._notebook_s3_key_string(checkpoint_path, checkpoint_name),
+            self.bucket.name,
+            self._notebook_s3_key_string(path, name))
 
-        return self.get_checkpoint_model(checkpoint_id, name, path)
+        return {
+            'id': checkpoint_id,
+            'last_modified': self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)['last_modified'],
+        }
 
+    @traced('restore_checkpoint')
     def restore_checkpoint(self, checkpoint_id, name, path=''):
         checkpoint_name = self.get_checkpoint_name(checkpoint_id, name)
         checkpoint_path = self.get_checkpoint_path(path)
 
-        self.log.info('Restoring {} from checkpoint {}'.format(name, checkpoint_name))
-        model = self.get_notebook(checkpoint_name, checkpoint_path)
-        model['name'] = name
-        self.create_notebook(model, path)
+        self.log.info('Restoring %s from checkpoint %s', name, checkpoint_name)
+        self.bucket.copy_key(
+            self._notebook_s3_key_string(path, name),
+            self.bucket.name,
+            self._notebook_s3_key_string(checkpoint_path, checkpoint_name))
 
+    @traced('list_checkpoints')
     def list_checkpoints(self, name, path=''):
         checkpoint_id = u'checkpoint'
         checkpoint_name = self.get_checkpoint_name(checkpoint_id, name)
@@ -1,23 +1,64 @@
+import base64
 import codecs
 from collections import namedtuple
 import datetime
+import io
+import itertools
+import mimetypes
+import os
+import shutil
+import socket
 import tempfile
 
 import boto
+from boto.exception import S3ResponseError
 
 from tornado import web
 
 from IPython import nbformat
 from IPython.html.services.contents.filecheckpoints import GenericFileCheckpoints
-from IPython.html.services.contents.manager import ContentsManager
-from IPython.utils import tz
+from IPython.html.services.contents.manager import ContentsManager, copy_pat
 
+from . import blobs, manifest, writebehind
+from .cache import MISSING, S3MetadataCache, TTLCache, cachedkey
+from .checkpoints import S3Checkpoints
+from .compression import check_codec, compress, decompressing_reader
+from .connection import S3ConnectionPool
+from .executor import S3Executor, TimeoutError
+from .invalidation import make_channel
+from .metrics import METRICS, traced
+from .notary import S3NotebookNotary
+from .scheduler import BACKGROUND, INTERACTIVE, SCHEDULER, THROTTLED_MESSAGE, is_throttled
+from .summary import summarize
+from .timestamps import S3_TIMEFORMAT_BUCKET_LIST, S3_TIMEFORMAT_GET_KEY, parse_s3_time, utcnow
+from .transfer import MB, S3Transfer
 
-# s3 return different time formats in different situations apparently
-S3_TIMEFORMAT_GET_KEY = '%a, %d %b %Y %H:%M:%S GMT'
-S3_TIMEFORMAT_BUCKET_LIST = '%Y-%m-%dT%H:%M:%S.000Z'
+
+# the fields every model of a type starts with, copied rather than rebuilt for each key
+_MODEL = {
+    'content': None,
+    'created': None,
+    'mimetype': None,
+    'writable': True,
+    'format': None,
+}
+DIRECTORY_MODEL = dict(_MODEL, type='directory')
+FILE_MODEL = dict(_MODEL, type='file')
+NOTEBOOK_MODEL = dict(_MODEL, type='notebook')
+
+# how many names new_untitled tries when others race it for the same one
+UNTITLED_ATTEMPTS = 10
+# how many times a manifest update is retried when other writers change it first
+MANIFEST_ATTEMPTS = 5
 
 fakekey = namedtuple('fakekey', 'name')
+# stands in for a HEAD of a key we just wrote, last_modified is in S3_TIMEFORMAT_GET_KEY
+savedkey = namedtuple('savedkey', 'name last_modified etag size')
+
+
+def _saved_key(name, etag, size=None, last_modified=None):
+    """ the savedkey of an upload, timed by s3's response to it when there was one """
+    return savedkey(name, last_modified or datetime.datetime.utcnow().strftime(S3_TIMEFORMAT_GET_KEY), etag, size)
 
 
 class S3ContentsManager(ContentsManager):
@@ -44,54 +85,34 @@ class S3ContentsManager(ContentsManager):
             return ''
 
     def _s3_key_dir_to_model(self, key):
-        self.log.debug("_s3_key_dir_to_model: %s: %s", key, key.name)
-        model = {
-            'name': self._get_key_dir_name(key.name),
-            'path': key.name.replace(self.s3_prefix, ''),
-            'last_modified': datetime.datetime.utcnow(), # key.last_modified,  will be used in an HTTP header
-            'created': None, # key.last_modified,
-            'type': 'directory',
-            'content': None,
-            'mimetype': None,
-            'writable': True,
-            'format': None,
-        }
-        self.log.debug("_s3_key_dir_to_model: %s: %s", key.name, model)
-        return model
+        return dict(
+            DIRECTORY_MODEL,
+            name=self._get_key_dir_name(key.name),
+            path=key.name[len(self.s3_prefix):],
+            # will be used in an HTTP header, so it should only move when the directory changes
+            last_modified=self._dir_last_modified(key.name))
 
     def _s3_key_file_to_model(self, key, timeformat):
-        self.log.debug("_s3_key_file_to_model: %s: %s", key, key.name)
-        model = {
-            'content': None,
-            'name': key.name.rsplit(self.s3_key_delimiter, 1)[-1],
-            'path': key.name.replace(self.s3_prefix, ''),
-            'last_modified': datetime.datetime.strptime(
-                key.last_modified, timeformat).replace(tzinfo=tz.UTC),
-            'created': None,
-            'type': 'file',
-            'mimetype': None,
-            'writable': True,
-            'format': None,
-        }
-        self.log.debug("_s3_key_file_to_model: %s: %s", key.name, model)
-        return model
+        return dict(
+            FILE_MODEL,
+            name=key.name.rpartition(self.s3_key_delimiter)[2],
+            path=key.name[len(self.s3_prefix):],
+            last_modified=parse_s3_time(key.last_modified, timeformat),
+            etag=getattr(key, 'etag', None))
 
     def _s3_key_notebook_to_model(self, key, timeformat):
-        self.log.debug("_s3_key_notebook_to_model: %s: %s", key, key.name)
-        model = {
-            'content': None,
-            'name': key.name.rsplit(self.s3_key_delimiter, 1)[-1],
-            'path': key.name.replace(self.s3_prefix, ''),
-            'last_modified': datetime.datetime.strptime(
-                key.last_modified, timeformat).replace(tzinfo=tz.UTC),
-            'created': None,
-            'type': 'notebook',
-            'mimetype': None,
-            'writable': True,
-            'format': None,
-        }
-        self.log.debug("_s3_key_notebook_to_model: %s: %s", key.name, model)
-        return model
+        last_modified = parse_s3_time(key.last_modified, timeformat)
+        if self._write_behind is not None:
+            flushed = self._written_behind.get(key.name, None)
+            if flushed is not None and flushed[0] == getattr(key, 'etag', None):
+                # the frontend compares this with what the save returned before it saves again
+                last_modified = parse_s3_time(flushed[1], S3_TIMEFORMAT_GET_KEY)
+        return dict(
+            NOTEBOOK_MODEL,
+            name=key.name.rpartition(self.s3_key_delimiter)[2],
+            path=key.name[len(self.s3_prefix):],
+            last_modified=last_modified,
+            etag=getattr(key, 'etag', None))
 
     def __init__(self, **kwargs):
         super(S3ContentsManager, self).__init__(**kwargs)
@@ -102,132 +123,631 @@ class S3ContentsManager(ContentsManager):
         # ensure prefix ends with the delimiter
         if not self.s3_prefix.endswith(self.s3_key_delimiter) and self.s3_prefix != '':
             self.s3_prefix += self.s3_key_delimiter
-        self.s3_connection = boto.connect_s3()
-        self.bucket = self.s3_connection.get_bucket(self.s3_bucket)
+        # connections are shared process-wide, the bucket handle is not validated up front
+        self.s3_connection_pool = S3ConnectionPool.shared(
+            size=config.get('s3_connection_pool_size', 10),
+            max_age=config.get('s3_connection_max_age', 300),
+            timeout=config.get('s3_request_timeout', 60))
+        self.bucket = self.s3_connection_pool.bucket(self.s3_bucket)
+        # rate limits and throttling retries are process-wide like the pool, the last manager's settings win
+        SCHEDULER.configure(
+            read_rate=config.get('s3_rate_limit_reads', 5500),
+            write_rate=config.get('s3_rate_limit_writes', 3500),
+            prefix_depth=config.get('s3_rate_limit_prefix_depth', 1),
+            delimiter=self.s3_key_delimiter,
+            retries=config.get('s3_throttle_retries', 8),
+            backoff_base=config.get('s3_backoff_base', 0.05),
+            backoff_max=config.get('s3_backoff_max', 20.0))
+        self.s3_cache = S3MetadataCache(
+            ttl=config.get('s3_cache_ttl', 30),
+            max_entries=config.get('s3_cache_max_entries', 1000),
+            delimiter=self.s3_key_delimiter,
+            content_max_bytes=config.get('s3_content_cache_size', 64 * MB),
+            max_listing_keys=config.get('s3_cache_max_listing_keys', 10000),
+            channel=make_channel(
+                config.get('s3_invalidation_channel', None),
+                log=self.log,
+                **config.get('s3_invalidation_channel_kwargs', {})),
+            bucket=self.s3_bucket)
+        # the etag each path had when this server last read or wrote it, saves are made with If-Match
+        self.s3_conditional_saves = config.get('s3_conditional_saves', True)
+        self._etags = TTLCache(ttl=24 * 60 * 60, max_entries=10000)
+        self.s3_executor = S3Executor(
+            max_workers=config.get('s3_max_concurrency', 8),
+            timeout=config.get('s3_request_timeout', 60))
+        self.s3_spool_max_size = config.get('s3_spool_max_size', 32 * MB)
+        # files larger than this are opened as a read-only preview of their beginning
+        self.s3_file_preview_size = config.get('s3_file_preview_size', 10 * MB)
+        # the etag of each path opened as a preview, which can't be saved over the whole file
+        self._previews = TTLCache(ttl=24 * 60 * 60, max_entries=10000)
+        self.s3_transfer = S3Transfer(
+            threshold=config.get('s3_multipart_threshold', 64 * MB),
+            part_size=config.get('s3_multipart_chunksize', 16 * MB),
+            concurrency=config.get('s3_transfer_concurrency', 4),
+            retries=config.get('s3_transfer_retries', 3),
+            log=self.log)
+        self.s3_compression = config.get('s3_compression', None)
+        check_codec(self.s3_compression)
+        self.s3_output_blobs = config.get('s3_output_blobs', False)
+        self.s3_blob_min_size = config.get('s3_blob_min_size', 64 * 1024)
+        # digests of blobs known to be in s3, which never need uploading again
+        self._blobs_stored = TTLCache(ttl=24 * 60 * 60, max_entries=100000)
+        self.s3_manifests = config.get('s3_manifests', False)
+        for tracer in config.get('s3_tracers', []):
+            METRICS.add_tracer(tracer)
+        self._write_behind = None
+        # (etag, last_modified) of the flushed saves, whose saves returned when they were journaled
+        self._written_behind = TTLCache(ttl=24 * 60 * 60, max_entries=10000)
+        if config.get('s3_write_behind', False):
+            self._write_behind = writebehind.WriteBehindQueue(
+                config.get('s3_write_behind_dir', '~/.s3nb/journal'),
+                self._write_pending,
+                # servers on other prefixes of the bucket may share the directory
+                namespace=self.s3_bucket + '/' + self.s3_prefix,
+                max_pending=config.get('s3_write_behind_max_pending', 100),
+                delay=config.get('s3_write_behind_delay', 2.0),
+                log=self.log)
+            self._write_behind.replay()
         self.log.debug("initialized base_uri: %s bucket: %s prefix: %s",
             self.s3_base_uri, self.s3_bucket, self.s3_prefix)
 
     def _checkpoints_class_default(self):
         return GenericFileCheckpoints
 
-    def list_dirs(self, path):
-        self.log.debug('list_dirs: %s', locals())
+    def _notary_default(self):
+        # s3nb.handlers reads and saves notebooks on executor threads
+        return S3NotebookNotary(parent=self)
+
+    def _s3(self, func, *args, **kwargs):
+        """ run one blocking s3 call on the executor """
+        try:
+            return self.s3_executor.call(func, *args, **kwargs)
+        except (TimeoutError, socket.timeout):
+            raise web.HTTPError(504, u"Timed out waiting for s3: %s" % getattr(func, '__name__', func))
+        except S3ResponseError as e:
+            if is_throttled(e):
+                raise web.HTTPError(503, THROTTLED_MESSAGE)
+            raise
+
+    def _iter_keys(self, prefix, delimiter=''):
+        """ like bucket.list, but each page is fetched through the executor """
+        marker = ''
+        while True:
+            rs = self._s3(self.bucket.get_all_keys, prefix=prefix, delimiter=delimiter, marker=marker)
+            k = None
+            for k in rs:
+                yield k
+            if not rs.is_truncated or k is None:
+                break
+            marker = rs.next_marker or k.name
+
+    def _spool(self):
+        """ an in-memory buffer that only rolls over to disk above s3_spool_max_size """
+        return tempfile.SpooledTemporaryFile(max_size=self.s3_spool_max_size)
+
+    def _download(self, k, limit=None):
+        """ stream the body of k, or its first limit bytes, into a spooled buffer, rewound for reading """
+        t = self._spool()
+        try:
+            self._s3(self.s3_transfer.download, k, t, limit)
+            t.seek(0)
+        except Exception:
+            t.close()
+            raise
+        return t
+
+    def _fetch(self, key):
+        """
+        Returns (k, buffer) holding the body of key, or (None, None) if it
+        does not exist.  A body we already hold is revalidated with
+        If-None-Match, so an unchanged key costs a single 304.
+        """
+        cached = self.s3_cache.contents.get(key)
+        if cached is None:
+            k = self._get_key(key, cached=False)
+            if not k:
+                return None, None
+            t = self._download(k)
+        else:
+            k = boto.s3.key.Key(self.bucket, key)
+            try:
+                self._s3(k.open_read, headers={'If-None-Match': cached[0].etag})
+            except S3ResponseError as e:
+                if e.status == 304:
+                    self.log.debug('_fetch: %s unchanged at %s', key, cached[0].etag)
+                    return cached[0], io.BytesIO(cached[1])
+                if e.status == 404:
+                    self.s3_cache.invalidate_key(key)
+                    return None, None
+                raise
+            t = self._spool()
+            try:
+                self._s3(shutil.copyfileobj, k, t)
+                t.seek(0)
+            except Exception:
+                t.close()
+                raise
+        if k.size is not None and k.size <= self.s3_cache.contents.max_bytes:
+            self.s3_cache.contents.set(k, t.read())
+            t.seek(0)
+        return k, t
+
+    def _get_key(self, key, cached=True):
+        k = self.s3_cache.heads.get(key) if cached else MISSING
+        if k is MISSING:
+            k = self._s3(self.bucket.get_key, key)
+            self.s3_cache.heads.set(key, k)
+        return k
+
+    def _iter_dir_keys(self, path):
+        """ the keys and prefixes directly under path, including its own placeholder key """
         key = self._path_to_s3_key_dir(path)
-        self.log.debug('list_dirs: looking in bucket:%s under:%s', self.bucket.name, key)
-        dirs = []
-        for k in self.bucket.list(key, self.s3_key_delimiter):
-            if k.name.endswith(self.s3_key_delimiter) and k.name != key:
-                dirs.append(self._s3_key_dir_to_model(k))
-                self.log.debug('list_dirs: found %s', k.name)
-        return dirs
+        if self.s3_manifests:
+            m, _ = self._read_manifest(key)
+            if m is not None:
+                for k in manifest.iter_keys(m, key):
+                    yield k
+                return
+        keys = self.s3_cache.listings.get(key)
+        if keys is MISSING:
+            self.log.debug('_iter_dir_keys: looking in bucket:%s under:%s', self.bucket.name, key)
+            generation = self.s3_cache.generation(key)
+            keys = []
+            for k in self._iter_keys(key, self.s3_key_delimiter):
+                if keys is not None:
+                    if len(keys) < self.s3_cache.max_listing_keys:
+                        # boto keys hold far more than a listing needs
+                        keys.append(manifest.manifestkey(k.name, getattr(k, 'last_modified', None),
+                                                         getattr(k, 'etag', None), getattr(k, 'size', None)))
+                    else:
+                        # too big to keep, it is streamed every time
+                        keys = None
+                yield k
+            if keys is None:
+                self.log.debug('_iter_dir_keys: not caching the listing of %s, it has over %d keys',
+                               key, self.s3_cache.max_listing_keys)
+                return
+            if self.s3_cache.generation(key) != generation:
+                # a write under key raced the listing, which may not include it
+                return
+            # only a completely consumed listing is cached
+            self.s3_cache.listings.set(key, keys)
+            if self.s3_manifests and keys:
+                self._create_manifest(key, keys)
+        else:
+            for k in keys:
+                yield k
 
-    def list_files(self, path):
-        self.log.debug('list_files: %s', locals())
+    def iter_dir(self, path):
+        """
+        stream notebook and file models under path from a single LIST, then
+        those of its folders, each of which needs a listing of its own for its
+        last_modified unless that is already known
+        """
+        self.log.debug('iter_dir: %s', path)
+        hidden = self._hidden_dir_names()
         key = self._path_to_s3_key_dir(path)
-        self.log.debug('list_files: looking in bucket:%s under:%s', self.bucket.name, key)
-        files = []
-        for k in self.bucket.list(key, self.s3_key_delimiter):
-            if not k.name.endswith(self.s3_key_delimiter) and not k.name.endswith('.ipynb') and k.name != key:
-                files.append(self._s3_key_file_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST))
-                self.log.debug('list_files: found %s', k.name)
-        return files
+        generation = self.s3_cache.generation(key)
+        newest = None
+        folders = []
+        for k in self._iter_dir_keys(path):
+            if k.name.endswith(self.s3_key_delimiter):
+                if k.name != key and self._get_key_dir_name(k.name) not in hidden:
+                    folders.append(k)
+                # prefixes carry no time, a placeholder object for the directory does
+                if getattr(k, 'last_modified', None) is None:
+                    continue
+            if newest is None or k.last_modified > newest:
+                # listing timestamps sort as strings
+                newest = k.last_modified
+            if k.name == key or k.name[len(key):] == manifest.MANIFEST_NAME:
+                continue
+            elif k.name.endswith('.ipynb'):
+                yield self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)
+            else:
+                yield self._s3_key_file_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)
+        if newest is not None:
+            self.s3_cache.set_last_modified(key, parse_s3_time(newest, S3_TIMEFORMAT_BUCKET_LIST), generation)
+        for k in folders:
+            yield self._s3_key_dir_to_model(k)
+
+    @staticmethod
+    def _newest(keys):
+        """ the newest last_modified of keys in the listing format, None if none has one """
+        newest = None
+        for k in keys:
+            # listing timestamps sort as strings
+            if getattr(k, 'last_modified', None) is not None and (newest is None or k.last_modified > newest):
+                newest = k.last_modified
+        return newest
+
+    def _dir_last_modified(self, key):
+        """
+        when the directory key last changed: the newest key directly in it, or
+        failing that the newest of the first page of keys below it, so every
+        replica works out the same time from s3
+        """
+        when = self.s3_cache.last_modified(key)
+        if when is not None:
+            return when
+        generation = self.s3_cache.generation(key)
+        newest = self._newest(self._iter_dir_keys(key[len(self.s3_prefix):]))
+        if newest is None:
+            # only folders in it
+            newest = self._newest(self._s3(self.bucket.get_all_keys, prefix=key))
+        if newest is None:
+            # nothing in s3 at all, e.g. the root of an empty bucket, so nothing to remember either
+            return utcnow()
+        when = parse_s3_time(newest, S3_TIMEFORMAT_BUCKET_LIST)
+        self.s3_cache.set_last_modified(key, when, generation)
+        return when
+
+    def _hidden_dir_names(self):
+        """ folders s3nb keeps its own bookkeeping in, left out of listings """
+        hidden = set([blobs.BLOB_DIR])
+        if isinstance(self.checkpoints, S3Checkpoints):
+            hidden.add(self.checkpoints.checkpoint_dir)
+        return hidden
 
+    def _list_dir(self, path):
+        dirs, notebooks, files = [], [], []
+        by_type = {'directory': dirs, 'notebook': notebooks, 'file': files}
+        for model in self.iter_dir(path):
+            by_type[model['type']].append(model)
+        self.log.debug('_list_dir: %s has %d dirs, %d notebooks, %d files', path, len(dirs), len(notebooks), len(files))
+        return dirs, notebooks, files
+
+    @traced('list_dirs')
+    def list_dirs(self, path):
+        self.log.debug('list_dirs: %s', path)
+        return self._list_dir(path)[0]
+
+    @traced('list_files')
+    def list_files(self, path):
+        self.log.debug('list_files: %s', path)
+        return self._list_dir(path)[2]
+
+    @traced('list_notebooks')
     def list_notebooks(self, path=''):
-        self.log.debug('list_notebooks: %s', locals())
-        key = self._path_to_s3_key_dir(path)
-        self.log.debug('list_notebooks: looking in bucket:%s under:%s', self.bucket.name, key)
-        notebooks = []
-        for k in self.bucket.list(key, self.s3_key_delimiter):
-            if k.name.endswith('.ipynb'):
-                notebooks.append(self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST))
-                self.log.debug('list_notebooks: found %s', k.name)
-        return notebooks
+        self.log.debug('list_notebooks: %s', path)
+        return self._list_dir(path)[1]
+
+    def _is_dir(self, path):
+        return not self.file_exists(path) and self.dir_exists(path)
+
+    def _delete_keys(self, keys):
+        """ delete keys in parallel batches of up to 1000, returns [(key, error)] for those that failed """
+        def delete_batch(batch):
+            try:
+                result = self.bucket.delete_keys(batch, quiet=True)
+            except Exception as e:
+                return [(k, str(e)) for k in batch]
+            return [(e.key, e.message) for e in result.errors]
+
+        batches = [keys[i:i + 1000] for i in range(0, len(keys), 1000)]
+        failed = []
+        # not under s3_request_timeout as a whole, each request is bounded and every failure is reported
+        for errors in self.s3_transfer.map(delete_batch, batches):
+            failed.extend(errors)
+        return failed
+
+    def _raise_partial_failure(self, action, path, failed, total):
+        self.log.error('%s %s: %d of %d keys failed: %s', action, path, len(failed), total, failed)
+        raise web.HTTPError(500, u'Failed to %s %d of %d keys under %s: %s' % (
+            action, len(failed), total, path, u', '.join(k for k, _ in failed[:10])))
+
+    def _delete_dir(self, path):
+        prefix = self._path_to_s3_key_dir(path)
+        keys = [k.name for k in self._iter_keys(prefix)]
+        self.log.debug('removing %d keys in bucket: %s under %s', len(keys), self.bucket.name, prefix)
+        try:
+            failed = self._delete_keys(keys)
+        finally:
+            self.s3_cache.invalidate_prefix(prefix)
+            self._etags.invalidate_prefix(path.strip('/') + '/')
+        if failed:
+            self._raise_partial_failure('delete', path, failed, len(keys))
+
+    def _rename_dir(self, old_path, new_path):
+        src_prefix = self._path_to_s3_key_dir(old_path)
+        dst_prefix = self._path_to_s3_key_dir(new_path)
+        if self.dir_exists(new_path):
+            raise web.HTTPError(409, u'Directory with name already exists: %s' % dst_prefix)
+
+        def copy_key(src_key):
+            try:
+                self.bucket.copy_key(dst_prefix + src_key[len(src_prefix):], self.bucket.name, src_key)
+            except Exception as e:
+                return src_key, e
+            return src_key, None
+
+        keys = [k.name for k in self._iter_keys(src_prefix)]
+        self.log.debug('copying %d keys in bucket: %s from %s to %s', len(keys), self.bucket.name, src_prefix, dst_prefix)
+        try:
+            # the caches are only invalidated once every copy has finished
+            results = self.s3_transfer.map(copy_key, keys)
+            # only remove the originals that made it across
+            failed = [(k, str(e)) for k, e in results if e is not None]
+            failed.extend(self._delete_keys([k for k, e in results if e is None]))
+        finally:
+            self.s3_cache.invalidate_prefix(src_prefix)
+            self.s3_cache.invalidate_prefix(dst_prefix)
+            self._etags.invalidate_prefix(old_path.strip('/') + '/')
+        if failed:
+            self._raise_partial_failure('rename', old_path, failed, len(keys))
+
+    def _manifest_key(self, key_dir):
+        return key_dir + manifest.MANIFEST_NAME
+
+    def _read_manifest(self, key_dir):
+        """ (manifest, etag) of the directory key_dir, (None, None) if it has none """
+        k, t = self._fetch(self._manifest_key(key_dir))
+        if k is None:
+            return None, None
+        with t:
+            try:
+                return manifest.loads(t.read()), k.etag
+            except ValueError as e:
+                # treated as missing, so listings fall back to LIST and updates end up replacing it
+                self.log.warning('unreadable manifest for %s: %s', key_dir, e)
+                return None, None
+
+    def _write_manifest(self, key_dir, m, etag):
+        """ write m over the manifest at etag, or where there is none if etag is None; False if it changed first """
+        key = self._manifest_key(key_dir)
+        data = manifest.dumps(m)
+        headers = {'Content-Type': 'application/json'}
+        if etag:
+            headers['If-Match'] = etag
+        else:
+            headers['If-None-Match'] = '*'
+        try:
+            up = self._s3(self.s3_transfer.upload, self.bucket, key, io.BytesIO(data), len(data), headers)
+        except S3ResponseError as e:
+            if e.status == 412:
+                return False
+            raise
+        finally:
+            self.s3_cache.invalidate_key(key)
+        saved = _saved_key(key, up.etag, len(data), up.last_modified)
+        self.s3_cache.contents.set(cachedkey(key, saved.last_modified, up.etag, None, len(data)), data)
+        return True
+
+    def _create_manifest(self, key_dir, keys):
+        """ write the manifest of key_dir from a listing of it, unless someone else already has """
+        try:
+            self._write_manifest(key_dir, manifest.build(keys, key_dir, self.s3_key_delimiter), None)
+        except Exception as e:
+            self.log.warning('failed to create manifest for %s: %s', key_dir, e)
 
+    def _copied_entry(self, key, k):
+        return manifest.entry('notebook' if key.endswith('.ipynb') else 'file', None, k.etag, k.last_modified)
+
+    def _update_manifest(self, key, entry):
+        """ set key's entry in its directory's manifest, or remove it if entry is None """
+        if not self.s3_manifests:
+            return
+        head, delimiter, _ = key.rstrip(self.s3_key_delimiter).rpartition(self.s3_key_delimiter)
+        key_dir = head + delimiter
+        # the root's own entry would belong to a manifest above s3_prefix
+        if len(key_dir) < len(self.s3_prefix):
+            return
+        try:
+            self._apply_manifest_update(key_dir, key[len(key_dir):], entry)
+        except Exception as e:
+            self.log.warning('failed to update manifest of %s, removing it to be rebuilt: %s', key_dir, e)
+            try:
+                self._s3(self.bucket.delete_key, self._manifest_key(key_dir))
+            except Exception:
+                pass
+            self.s3_cache.invalidate_key(self._manifest_key(key_dir))
+
+    def _apply_manifest_update(self, key_dir, name, entry):
+        for _ in range(MANIFEST_ATTEMPTS):
+            m, etag = self._read_manifest(key_dir)
+            if m is None:
+                # the next listing of key_dir writes one, too big a directory never has one;
+                # the directory may be new to its parent though
+                if entry is not None:
+                    self._update_manifest(key_dir, manifest.entry('directory'))
+                return
+            entries = m['entries']
+            if entries.get(name) == entry:
+                return
+            if entry is None:
+                del entries[name]
+            else:
+                entries[name] = entry
+            if not entries:
+                # an empty directory has nothing to keep it in s3 but its manifest
+                self._s3(self.bucket.delete_key, self._manifest_key(key_dir))
+                self.s3_cache.invalidate_key(self._manifest_key(key_dir))
+                if not any(True for _ in itertools.islice(self._iter_keys(key_dir), 1)):
+                    self._update_manifest(key_dir, None)
+                return
+            if self._write_manifest(key_dir, m, etag):
+                return
+        raise web.HTTPError(409, u'Manifest of %s kept changing' % key_dir)
+
+    @traced('delete')
     def delete(self, path):
-        self.log.debug('delete: %s', locals())
+        self.log.debug('delete: %s', path)
+        if path.strip(self.s3_key_delimiter) == '':
+            raise web.HTTPError(400, u"Can't delete root")
+        if self._is_dir(path):
+            self._flush_pending(self._path_to_s3_key_dir(path))
+            self._delete_dir(path)
+            self._update_manifest(self._path_to_s3_key_dir(path), None)
+            return
         key = self._path_to_s3_key(path)
+        self._flush_pending(key)
         self.log.debug('removing notebook in bucket: %s : %s', self.bucket.name, key)
-        self.bucket.delete_key(key)
+        self._s3(self.bucket.delete_key, key)
+        self.s3_cache.invalidate_key(key)
+        self._update_manifest(key, None)
+        self._etags.invalidate(path.strip('/'))
+        self.checkpoints.delete_all_checkpoints(path)
 
+    @traced('get')
     def get(self, path, content=True, type=None, format=None):
-        self.log.debug('get: %s', locals())
+        self.log.debug('get: %s content=%s type=%s format=%s', path, content, type, format)
         # get: {'content': 1, 'path': '', 'self': <ipy3.S3ContentsManager object at 0x10a650e90>, 'type': u'directory', 'format': None}
         # get: {'content': False, 'path': u'graphaelli/notebooks/2015-01 Hack.ipynb', 'self': <ipy3.S3ContentsManager object at 0x10d60ce90>, 'type': None, 'format': None}
 
         if type == 'directory':
             key = self._path_to_s3_key_dir(path)
-            model = self._s3_key_dir_to_model(fakekey(key))
             if content:
-                model['content'] = self.list_dirs(path) + self.list_notebooks(path) + self.list_files(path)
+                # listing first works out the directory's last_modified from its newest key
+                dirs, notebooks, files = self._list_dir(path)
+                model = self._s3_key_dir_to_model(fakekey(key))
+                model['content'] = dirs + notebooks + files
                 model['format'] = 'json'
+            else:
+                model = self._s3_key_dir_to_model(fakekey(key))
             return model
         elif type == 'notebook' or (type is None and path.endswith('.ipynb')):
             key = self._path_to_s3_key(path)
-            k = self.bucket.get_key(key)
+            # a save still being written behind is newer than what s3 has
+            k, t = self._pending_save(key)
+            if k is None:
+                if content:
+                    k, t = self._fetch(key)
+                    if k:
+                        self._etags.set(path.strip('/'), k.etag)
+                        if self._write_behind is not None:
+                            self._write_behind.resolved(key)
+                else:
+                    k = self._get_key(key)
             if not k:
                 raise web.HTTPError(400, "{} not found".format(key))
             model = self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_GET_KEY)
             if content:
-                try:
-                    with tempfile.NamedTemporaryFile() as t:
-                        # download bytes
-                        k.get_file(t)
-                        t.seek(0)
-                        # read with utf-8 encoding
-                        with codecs.open(t.name, mode='r', encoding='utf-8') as f:
-                            nb = nbformat.read(f, as_version=4)
-                except Exception as e:
-                    raise web.HTTPError(400, u"Unreadable Notebook: %s %s" % (path, e))
+                nb = self._read_notebook(path, k, t)
                 self.mark_trusted_cells(nb, path)
                 model['content'] = nb
                 model['format'] = 'json'
                 self.validate_notebook_model(model)
             return model
+        elif content and path.endswith('.ipynb'):
+            # /files/ and downloads of a notebook as a file, which s3 may hold compressed and without its blobs
+            key = self._path_to_s3_key(path)
+            k, t = self._pending_save(key)
+            if k is None:
+                k, t = self._fetch(key)
+            if not k:
+                raise web.HTTPError(404, u'No such file: %s' % path)
+            data = nbformat.writes(self._read_notebook(path, k, t), version=nbformat.NO_CONVERT).encode('utf-8')
+            model = self._s3_key_file_to_model(k, timeformat=S3_TIMEFORMAT_GET_KEY)
+            model['content'], model['format'] = self._read_file(path, data, format)
+            model['mimetype'] = 'text/plain' if model['format'] == 'text' else 'application/octet-stream'
+            return model
         else: # assume that it is file
             key = self._path_to_s3_key(path)
-            k = self.bucket.get_key(key)
+            k = self._get_key(key, cached=not content)
+            if not k:
+                raise web.HTTPError(404, u'No such file: %s' % path)
 
             model = self._s3_key_file_to_model(k, timeformat=S3_TIMEFORMAT_GET_KEY)
+            model['mimetype'] = mimetypes.guess_type(path)[0]
+            truncated = (bool(self.s3_file_preview_size) and k.size > self.s3_file_preview_size
+                         and not path.endswith('.ipynb'))
+            if truncated:
+                # the editor can only ever be given a preview of it
+                model['writable'] = False
 
             if content:
                 try:
-                    model['content'] = k.get_contents_as_string()
+                    # never more than the preview in memory, however large the file
+                    with self._download(k, self.s3_file_preview_size) as t:
+                        data = t.read()
+                    self._etags.set(path.strip('/'), k.etag)
+                except web.HTTPError:
+                    raise
                 except Exception as e:
                     raise web.HTTPError(400, u"Unreadable file: %s %s" % (path, e))
 
-                model['mimetype'] = 'text/plain'
-                model['format'] = 'text'
+                model['content'], model['format'] = self._read_file(path, data, format, truncated)
+                if not model['mimetype']:
+                    model['mimetype'] = 'text/plain' if model['format'] == 'text' else 'application/octet-stream'
+                if truncated:
+                    # IPython's editor saves whatever it was given regardless of writable
+                    self._previews.set(path.strip('/'), k.etag)
+                    self.log.info('get: opened the first %d of %d bytes of %s', len(data), k.size, path)
+                else:
+                    self._previews.invalidate(path.strip('/'))
 
             return model
 
+    def _read_notebook(self, path, k, t):
+        """ the notebook in t, the body of k, decompressed and with the outputs it keeps in blobs put back """
+        try:
+            with t:
+                # decompress if needed, then read with utf-8 encoding
+                body = decompressing_reader(t, k.content_encoding)
+                nb = nbformat.read(codecs.getreader('utf-8')(body), as_version=4)
+        except Exception as e:
+            raise web.HTTPError(400, u"Unreadable Notebook: %s %s" % (path, e))
+        # outputs saved as blobs are put back whether or not s3_output_blobs is still on
+        digests = blobs.references(nb)
+        if digests:
+            blobs.restore(nb, self._load_blobs(digests))
+        return nb
+
+    def _read_file(self, path, data, format, truncated=False):
+        """ (content, format) for the body data of path, like FileContentsManager._read_file """
+        if format is None or format == 'text':
+            try:
+                return data.decode('utf-8'), 'text'
+            except UnicodeDecodeError as e:
+                # a preview can end part way through a character
+                if truncated and e.start >= len(data) - 3 and e.end == len(data):
+                    return data[:e.start].decode('utf-8'), 'text'
+                if format == 'text':
+                    raise web.HTTPError(400, u'%s is not UTF-8 encoded' % path, reason='bad format')
+        return base64.b64encode(data).decode('ascii'), 'base64'
+
+    def get_async(self, path, content=True, type=None, format=None):
+        """ run get on the s3 executor and return a future for tornado coroutines """
+        # opening a notebook or file goes ahead of tree listings and autosaves
+        priority = BACKGROUND if type == 'directory' else INTERACTIVE
+        return self.s3_executor.submit_as(priority, self.get, path, content=content, type=type, format=format)
+
+    def save_async(self, model, path):
+        """ run save on the s3 executor and return a future for tornado coroutines """
+        return self.s3_executor.submit_as(BACKGROUND, self.save, model, path)
+
+    @traced('dir_exists')
     def dir_exists(self, path):
-        self.log.debug('dir_exists: %s', locals())
-        key = self._path_to_s3_key(path)
-        if path == '':
+        self.log.debug('dir_exists: %s', path)
+        if path.strip(self.s3_key_delimiter) == '':
             return True
-        else:
-            try:
-                next(iter(self.bucket.list(key, self.s3_key_delimiter)))
-                return True
-            except StopIteration:
-                return False
+        # list under the delimiter so 'sub' doesn't match 'subway.txt'
+        key = self._path_to_s3_key_dir(path)
+        exists = self.s3_cache.dirs.get(key)
+        if exists is MISSING:
+            rs = self._s3(self.bucket.get_all_keys, prefix=key, delimiter=self.s3_key_delimiter, max_keys=1)
+            exists = len(rs) > 0
+            self.s3_cache.dirs.set(key, exists)
+        return exists
 
     def is_hidden(self, path):
-        self.log.debug('is_hidden %s', locals())
+        self.log.debug('is_hidden: %s', path)
         return False
 
+    @traced('file_exists')
     def file_exists(self, path):
-        self.log.debug('file_exists: %s', locals())
+        self.log.debug('file_exists: %s', path)
         if path == '':
             return False
         key = self._path_to_s3_key(path)
-        k = self.bucket.get_key(key)
+        k = self._get_key(key)
         return k is not None and not k.name.endswith(self.s3_key_delimiter)
 
     exists = file_exists
 
+    @traced('new_untitled')
     def new_untitled(self, path='', type='', ext=''):
-        self.log.debug('new_untitled: %s', locals())
+        self.log.debug('new_untitled: %s type=%s ext=%s', path, type, ext)
         model = {
             'mimetype': None,
             'created': datetime.datetime.utcnow(),
@@ -255,63 +775,291 @@ class S3ContentsManager(ContentsManager):
         else:
             raise web.HTTPError(400, "Unexpected model type: %r" % model['type'])
 
-        name = self.increment_filename(untitled + ext, self.s3_prefix + path, insert=insert)
-        path = u'{0}/{1}'.format(path, name)
-        model.update({
-            'name': name,
-            'path': path,
-        })
-        return self.new(model, path)
+        # what ContentsManager.new fills in, saved here so the write can be made create-only
+        if model['type'] == 'notebook':
+            model.update(content=nbformat.v4.new_notebook(), format='json')
+        elif model['type'] == 'file':
+            model.update(content='', format='text')
+
+        # the chosen name comes from a possibly stale listing, so the write
+        # only succeeds if nobody took the name meanwhile and we retry if they did
+        for attempt in range(UNTITLED_ATTEMPTS):
+            name = self.increment_filename(untitled + ext, path, insert=insert)
+            new_path = u'{0}/{1}'.format(path, name)
+            model.update({
+                'name': name,
+                'path': new_path,
+            })
+            try:
+                return self._save(model, new_path.strip('/'), create_only=True)
+            except web.HTTPError as e:
+                if e.status_code != 409:
+                    raise
+                self.log.debug('new_untitled: %s was taken, retrying', new_path)
+                self.s3_cache.invalidate_key(self._path_to_s3_key(new_path))
+        raise web.HTTPError(409, u'Could not pick an untitled name in %s' % path)
+
+    def increment_filename(self, filename, path='', insert=''):
+        """ like ContentsManager.increment_filename, but checks candidates against one listing """
+        path = path.strip('/')
+        basename, ext = os.path.splitext(filename)
+        taken = set(m['name'] for m in self.iter_dir(path))
+        for i in itertools.count():
+            if i:
+                insert_i = '{}{}'.format(insert, i)
+            else:
+                insert_i = ''
+            name = u'{basename}{insert}{ext}'.format(basename=basename,
+                insert=insert_i, ext=ext)
+            if name not in taken:
+                return name
 
-    def _save_file(self, path, content, format):
-        if format != 'text':
-            raise web.HTTPError(400, u'Only text files are supported')
+    def _upload(self, path, key, fp, size, headers=None, create_only=False, etag=None):
+        """
+        upload fp to key, or only create it with create_only, a failed write precondition becomes a 409; returns its savedkey
 
+        etag is the version the client read, without it this server's last read or write of path stands in
+        """
+        headers = dict(headers or {})
+        path = path.strip('/')
+        if create_only:
+            headers['If-None-Match'] = '*'
+        elif self.s3_conditional_saves:
+            etag = etag or self._etags.get(path, None)
+            if etag:
+                headers['If-Match'] = etag
         try:
-            bcontent = content.encode('utf8')
+            up = self._s3(self.s3_transfer.upload, self.bucket, key, fp, size, headers)
+        except S3ResponseError as e:
+            if e.status in (409, 412):
+                self.log.warning('_upload: %s changed since we last read it, refusing to overwrite', path)
+                raise web.HTTPError(409, u'%s was changed by someone else, reload it before saving' % path)
+            raise
+        self._etags.set(path, up.etag)
+        return _saved_key(key, up.etag, size, up.last_modified)
+
+    def _save_file(self, path, content, format, create_only=False, etag=None):
+        if format not in ('text', 'base64'):
+            raise web.HTTPError(400, u"Must specify format of file contents as 'text' or 'base64'")
+
+        try:
+            if format == 'text':
+                bcontent = content.encode('utf8')
+            else:
+                bcontent = base64.b64decode(content.encode('ascii'))
         except Exception as e:
-            raise web.HTTPError(400, u'Encoding error saving {}: {}'.format(content, e))
+            raise web.HTTPError(400, u'Encoding error saving %s: %s' % (path, e))
 
-        k = boto.s3.key.Key(self.bucket)
-        k.key = self._path_to_s3_key(path)
+        key = self._path_to_s3_key(path)
+        self._check_not_preview(path, key)
+        mimetype = mimetypes.guess_type(path)[0] or (
+            'text/plain; charset=utf-8' if format == 'text' else 'application/octet-stream')
+        # already in memory, copying it into a spool would only put it on disk as well
+        saved = self._upload(path, key, io.BytesIO(bcontent), len(bcontent), {'Content-Type': mimetype},
+                             create_only, etag)
+        self.s3_cache.invalidate_key(key)
+        return saved
 
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(content)
-            f.seek(0)
-            k.set_contents_from_file(f)
+    def _check_not_preview(self, path, key):
+        """ refuse to save over a file that was only opened as a preview of its beginning """
+        path = path.strip('/')
+        previewed = self._previews.get(path, None)
+        if previewed is None:
+            return
+        k = self._get_key(key, cached=False)
+        if k is not None and k.etag == previewed:
+            raise web.HTTPError(403, u'Only the first %d bytes of %s were opened, saving them would cut it short' % (
+                self.s3_file_preview_size, path))
+        # it was replaced or deleted since, so this save doesn't overwrite what was previewed
+        self._previews.invalidate(path)
 
-    def _save_notebook(self, path, nb):
-        self.log.debug('_save_notebook: %s', locals())
+    def _blob_key(self, digest):
+        return self.s3_prefix + blobs.BLOB_DIR + self.s3_key_delimiter + digest
+
+    def _store_blobs(self, new_blobs):
+        """ upload those of {digest: data} not already in s3, in parallel """
+        def store(digest):
+            key = self._blob_key(digest)
+            # blobs are immutable, one that exists already is the same blob
+            if self.bucket.get_key(key) is None:
+                data = new_blobs[digest]
+                boto.s3.key.Key(self.bucket, key).set_contents_from_string(data)
+                self.log.debug('_store_blobs: stored %s bytes as %s', len(data), key)
+            self._blobs_stored.set(digest, True)
+
+        self.s3_transfer.map(store, [d for d in new_blobs if self._blobs_stored.get(d, None) is None])
+
+    def _load_blobs(self, digests):
+        """ {digest: data} for digests, fetched in parallel unless cached """
+        def load(digest):
+            key = self._blob_key(digest)
+            cached = self.s3_cache.contents.get(key)
+            if cached is not None:
+                return digest, cached[1]
+            k = boto.s3.key.Key(self.bucket, key)
+            try:
+                data = k.get_contents_as_string()
+            except S3ResponseError as e:
+                if e.status == 404:
+                    raise web.HTTPError(500, u"Missing output blob %s" % key)
+                raise
+            self.s3_cache.contents.set(k, data)
+            self._blobs_stored.set(digest, True)
+            return digest, data
 
-        k = boto.s3.key.Key(self.bucket)
-        k.key = self._path_to_s3_key(path)
+        return dict(self.s3_transfer.map(load, digests))
 
+    def _save_notebook(self, path, nb, create_only=False, etag=None):
+        self.log.debug('_save_notebook: %s %s', path, summarize(nb))
+
+        key = self._path_to_s3_key(path)
+        headers = {}
+        if self.s3_compression:
+            headers['Content-Encoding'] = self.s3_compression
         try:
-            with tempfile.NamedTemporaryFile() as t, codecs.open(t.name, mode='w', encoding='utf-8') as f:
-                # write tempfile with utf-8 encoding
-                nbformat.write(nb, f, version=nbformat.NO_CONVERT)
-                # upload as bytes (t's fp didn't advance)
-                k.set_contents_from_file(t)
+            if self.s3_output_blobs:
+                # blobs go first so the notebook never refers to one that isn't there
+                self._store_blobs(blobs.extract(nb, self.s3_blob_min_size))
+            # upload as utf-8 encoded bytes
+            data = compress(nbformat.writes(nb, version=nbformat.NO_CONVERT).encode('utf-8'), self.s3_compression)
+            if not create_only and self._can_write_behind(path, key):
+                saved = _saved_key(key, None, len(data))
+                if self._write_behind.put(key, path.strip('/'), data, headers,
+                                          etag=etag or self._etags.get(path.strip('/'), None),
+                                          last_modified=saved.last_modified,
+                                          timeout=self.s3_executor.timeout):
+                    return saved
+            return self._put_notebook(path, key, data, headers, create_only, etag)
+        except web.HTTPError:
+            raise
         except Exception as e:
             raise web.HTTPError(400, u"Unexpected Error Writing Notebook: %s %s" % (path, e))
 
+    def _put_notebook(self, path, key, data, headers, create_only=False, etag=None):
+        """ upload the encoded body of a notebook, returns its savedkey """
+        try:
+            saved = self._upload(path, key, io.BytesIO(data), len(data), headers, create_only, etag)
+        finally:
+            self.s3_cache.invalidate_key(key)
+        # keep what we wrote so reopening it only costs a 304
+        self.s3_cache.contents.set(
+            cachedkey(key, saved.last_modified, saved.etag, headers.get('Content-Encoding'), len(data)), data)
+        return saved
+
+    def _can_write_behind(self, path, key):
+        """ only saves of notebooks this server has read or written are written behind """
+        path = path.strip('/')
+        return (self._write_behind is not None and self._etags.get(path, None) is not None
+                and key not in self._write_behind.conflicts)
+
+    def _pending_save(self, key):
+        """ (k, buffer) of the save of key still being written behind, or (None, None) """
+        pending = self._write_behind.get(key) if self._write_behind is not None else None
+        if pending is None:
+            return None, None
+        return (cachedkey(key, pending.last_modified, None, pending.headers.get('Content-Encoding'), len(pending.data)),
+                io.BytesIO(pending.data))
+
+    @traced('write_behind')
+    def _write_pending(self, pending):
+        """ upload a journaled save, called from the write-behind flusher """
+        try:
+            # after a restart pending.etag is all that says which version the save was based on
+            saved = self._put_notebook(pending.path, pending.key, pending.data, dict(pending.headers), etag=pending.etag)
+        except web.HTTPError as e:
+            if e.status_code == 409:
+                raise writebehind.Conflict(e.log_message)
+            raise
+        self._written_behind.set(pending.key, (saved.etag, pending.last_modified))
+        self._update_manifest(saved.name, manifest.entry(
+            'notebook', saved.size, saved.etag, manifest.listing_time(saved.last_modified)))
+
+    def _flush_pending(self, prefix):
+        """ get saves being written behind under prefix into s3 before it is copied or deleted """
+        if self._write_behind is None:
+            return
+        left = self._write_behind.flush_prefix(prefix, timeout=self.s3_executor.timeout)
+        if left:
+            raise web.HTTPError(503, u'Saves of %s have not reached s3 yet, try again' % ', '.join(left))
+
+    @traced('rename')
     def rename(self, old_path, new_path):
-        self.log.debug('rename: %s', locals())
+        self.log.debug('rename: %s to %s', old_path, new_path)
         if new_path == old_path:
             return
+        if self._is_dir(old_path):
+            self._flush_pending(self._path_to_s3_key_dir(old_path))
+            self._rename_dir(old_path, new_path)
+            self._update_manifest(self._path_to_s3_key_dir(new_path), manifest.entry('directory'))
+            self._update_manifest(self._path_to_s3_key_dir(old_path), None)
+            return
 
         src_key = self._path_to_s3_key(old_path)
         dst_key = self._path_to_s3_key(new_path)
         self.log.debug('copying notebook in bucket: %s from %s to %s', self.bucket.name, src_key, dst_key)
-        if self.bucket.get_key(dst_key):
+        if self._get_key(dst_key, cached=False):
             raise web.HTTPError(409, u'Notebook with name already exists: %s' % dst_key)
-        self.bucket.copy_key(dst_key, self.bucket.name, src_key)
+        self._flush_pending(src_key)
+        k = self._s3(self.bucket.copy_key, dst_key, self.bucket.name, src_key)
+        self.s3_cache.invalidate_key(dst_key)
+        # whoever had the old path open now has the new one
+        if self._etags.get(old_path.strip('/'), None):
+            self._etags.set(new_path.strip('/'), k.etag)
         self.log.debug('removing notebook in bucket: %s : %s', self.bucket.name, src_key)
-        self.bucket.delete_key(src_key)
+        self._s3(self.bucket.delete_key, src_key)
+        self.s3_cache.invalidate_key(src_key)
+        self._etags.invalidate(old_path.strip('/'))
+        self._update_manifest(dst_key, self._copied_entry(dst_key, k))
+        self._update_manifest(src_key, None)
+        self.checkpoints.rename_all_checkpoints(old_path, new_path)
+
+    @traced('copy')
+    def copy(self, from_path, to_path=None):
+        """ very similar to ContentsManager.copy, but copies the key server-side """
+        self.log.debug('copy: %s to %s', from_path, to_path)
+        path = from_path.strip('/')
+        if to_path is not None:
+            to_path = to_path.strip('/')
+
+        if '/' in path:
+            from_dir, from_name = path.rsplit('/', 1)
+        else:
+            from_dir = ''
+            from_name = path
+
+        if to_path is None:
+            to_path = from_dir
+        if self.dir_exists(to_path):
+            name = copy_pat.sub(u'.', from_name)
+            to_name = self.increment_filename(name, to_path, insert='-Copy')
+            to_path = u'{0}/{1}'.format(to_path, to_name)
+
+        src_key = self._path_to_s3_key(path)
+        dst_key = self._path_to_s3_key(to_path)
+        self.log.debug('copying in bucket: %s from %s to %s', self.bucket.name, src_key, dst_key)
+        self._flush_pending(src_key)
+        try:
+            k = self._s3(self.bucket.copy_key, dst_key, self.bucket.name, src_key)
+        except S3ResponseError as e:
+            if e.status == 404:
+                raise web.HTTPError(404, u'No such file: %s' % path)
+            raise
+        finally:
+            self.s3_cache.invalidate_key(dst_key)
+        self._update_manifest(dst_key, self._copied_entry(dst_key, k))
+
+        if to_path.endswith('.ipynb'):
+            return self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)
+        return self._s3_key_file_to_model(k, timeformat=S3_TIMEFORMAT_BUCKET_LIST)
 
+    @traced('save')
     def save(self, model, path):
         """ very similar to filemanager.save """
-        self.log.debug('save: %s', locals())
+        return self._save(model, path)
+
+    def _save(self, model, path, create_only=False):
+        """ save, failing with a 409 if path already exists when create_only is set """
+        self.log.debug('save: %s %s', path, summarize(model))
 
         if 'type' not in model:
             raise web.HTTPError(400, u'No file type provided')
@@ -323,20 +1071,31 @@ class S3ContentsManager(ContentsManager):
         if model['type'] == 'notebook':
             nb = nbformat.from_dict(model['content'])
             self.check_and_sign(nb, path)
-            self._save_notebook(path, nb)
+            k = self._save_notebook(path, nb, create_only, model.get('etag'))
         elif model['type'] == 'file':
-            self._save_file(path, model['content'], model.get('format'))
+            k = self._save_file(path, model['content'], model.get('format'), create_only, model.get('etag'))
         elif model['type'] == 'directory':
-            pass  # keep symmetry with filemanager.save
+            k = None  # keep symmetry with filemanager.save
         else:
             raise web.HTTPError(400, "Unhandled contents type: %s" % model['type'])
+        if k is None:
+            self._update_manifest(self._path_to_s3_key_dir(path), manifest.entry('directory'))
+        elif k.etag is not None:  # saves written behind update it once they reach s3
+            self._update_manifest(k.name, manifest.entry(
+                model['type'], k.size, k.etag, manifest.listing_time(k.last_modified)))
 
         validation_message = None
         if model['type'] == 'notebook':
             self.validate_notebook_model(model)
             validation_message = model.get('message', None)
 
-        model = self.get(path, content=False, type=model['type'])
+        # build the returned model from what we just wrote rather than another HEAD
+        if model['type'] == 'notebook':
+            model = self._s3_key_notebook_to_model(k, timeformat=S3_TIMEFORMAT_GET_KEY)
+        elif model['type'] == 'file':
+            model = self._s3_key_file_to_model(k, timeformat=S3_TIMEFORMAT_GET_KEY)
+        else:
+            model = self.get(path, content=False, type=model['type'])
         if validation_message:
             model['message'] = validation_message
 
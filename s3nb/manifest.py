@@ -0,0 +1,117 @@
+"""
+Per-directory manifests that let a folder be listed with one small GET.
+
+c.S3ContentsManager.s3_manifests = True
+
+keeps <dir>/.s3nb-manifest.json up to date with the name, type, size, etag
+and last_modified of everything directly in <dir>, using conditional writes
+so concurrent servers don't lose each other's updates.  A directory without
+a manifest is listed the usual way and its manifest written from that
+listing, unless it holds more keys than a listing is cached for; saves into
+it until then leave it alone.  When manifests drift, e.g. because keys were written by other
+tools, regenerate them from real listings:
+
+    python -m s3nb.manifest s3://bucket/notebook/prefix/
+"""
+import argparse
+from collections import namedtuple
+import json
+import logging
+
+from .timestamps import S3_TIMEFORMAT_BUCKET_LIST, S3_TIMEFORMAT_GET_KEY, parse_s3_time
+
+
+MANIFEST_NAME = '.s3nb-manifest.json'
+VERSION = 1
+
+# stands in for a listed key, last_modified is in S3_TIMEFORMAT_BUCKET_LIST and None for directories
+manifestkey = namedtuple('manifestkey', 'name last_modified etag size')
+
+
+def entry(type, size=None, etag=None, last_modified=None):
+    return {'type': type, 'size': size, 'etag': etag, 'last_modified': last_modified}
+
+
+def listing_time(last_modified):
+    """ a HEAD or PUT style timestamp in the listing format manifests use """
+    return parse_s3_time(last_modified, S3_TIMEFORMAT_GET_KEY).strftime(S3_TIMEFORMAT_BUCKET_LIST)
+
+
+def build(keys, prefix, delimiter='/'):
+    """ the manifest of prefix, from the keys and prefixes of a delimited listing of it """
+    entries = {}
+    for k in keys:
+        name = k.name[len(prefix):]
+        if not name or name == MANIFEST_NAME:
+            continue
+        if name.endswith(delimiter):
+            entries[name] = entry('directory')
+        else:
+            entries[name] = entry(
+                'notebook' if name.endswith('.ipynb') else 'file',
+                k.size, k.etag, k.last_modified)
+    return {'version': VERSION, 'entries': entries}
+
+
+def dumps(manifest):
+    return json.dumps(manifest, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    manifest = json.loads(data.decode('utf-8'))
+    if manifest.get('version') != VERSION:
+        raise ValueError('unsupported manifest version %r' % manifest.get('version'))
+    return manifest
+
+
+def iter_keys(manifest, prefix):
+    """ manifestkeys standing in for a listing of prefix """
+    for name, e in sorted(manifest['entries'].items()):
+        if e['type'] == 'directory':
+            yield manifestkey(prefix + name, None, None, None)
+        else:
+            yield manifestkey(prefix + name, e['last_modified'], e['etag'], e['size'])
+
+
+def rebuild(bucket, prefix, delimiter='/', recursive=True, log=None):
+    """ rewrite the manifest of prefix, and those below it if recursive, from real listings """
+    log = log or logging.getLogger(__name__)
+    pending = [prefix]
+    count = 0
+    while pending:
+        prefix = pending.pop()
+        keys = list(bucket.list(prefix, delimiter))
+        manifest = build(keys, prefix, delimiter)
+        bucket.new_key(prefix + MANIFEST_NAME).set_contents_from_string(
+            dumps(manifest), headers={'Content-Type': 'application/json'})
+        count += 1
+        log.info('rebuilt %s%s with %d entries', prefix, MANIFEST_NAME, len(manifest['entries']))
+        if recursive:
+            # s3nb's own checkpoint and blob folders are never listed
+            pending.extend(prefix + name for name, e in manifest['entries'].items()
+                           if e['type'] == 'directory' and not name.startswith('.ipynb_'))
+    return count
+
+
+def main(argv=None):
+    import boto
+
+    parser = argparse.ArgumentParser(description='Regenerate s3nb directory manifests from s3 listings.')
+    parser.add_argument('uri', help='s3://bucket/prefix/ of the directory to rebuild')
+    parser.add_argument('--delimiter', default='/')
+    parser.add_argument('--no-recursive', dest='recursive', action='store_false',
+                        help='only rebuild the manifest of the directory itself')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not args.uri.startswith('s3://'):
+        parser.error('expected an s3:// uri')
+    bucket_name, _, prefix = args.uri[5:].partition(args.delimiter)
+    if prefix and not prefix.endswith(args.delimiter):
+        prefix += args.delimiter
+    bucket = boto.connect_s3().get_bucket(bucket_name, validate=False)
+    rebuild(bucket, prefix, args.delimiter, args.recursive)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Counts, bytes and latency of the s3 requests made by each contents operation.
+
+Every pooled s3 connection reports its requests here, labelled with their
+verb (LIST, HEAD, GET, PUT, COPY, DELETE) and the contents operation that
+issued them, even when the request runs on another thread.  Load the
+server extension to serve them in prometheus' text format at /s3nb/metrics,
+to logged in users like the rest of the notebook server:
+
+c.NotebookApp.server_extensions = ['s3nb.metrics']
+
+Tracers are called with a finished Span for every contents operation and
+every s3 request, e.g. to forward them to a tracing system:
+
+c.S3ContentsManager.s3_tracers = ['mypackage.tracing.record_span']
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import logging
+import threading
+import time
+
+from tornado import web
+
+from IPython.html.base.handlers import IPythonHandler
+from IPython.utils.importstring import import_item
+from IPython.utils.py3compat import string_types
+
+
+OPERATION = 'operation'
+REQUEST = 's3'
+
+VERBS = ('LIST', 'HEAD', 'GET', 'PUT', 'COPY', 'DELETE')
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+log = logging.getLogger(__name__)
+_local = threading.local()
+
+
+class Span(object):
+    """
+    One contents operation (kind OPERATION) or s3 request (kind REQUEST).
+    operation names the outermost contents operation it belongs to, and
+    attributes carry the verb, key, status and bytes of requests.
+    """
+
+    def __init__(self, kind, name, parent=None, **attributes):
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.operation = parent.operation if parent is not None else name if kind == OPERATION else None
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def finish(self, error=None):
+        self.duration = time.time() - self.start
+        self.error = error
+
+    def __repr__(self):
+        return '<Span %s %s %s %.4fs>' % (self.kind, self.name, self.attributes, self.duration or 0)
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+def bind(func):
+    """ func, run under the calling thread's current span wherever it is called """
+    span = current_span()
+
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        previous = current_span()
+        _local.span = span
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.span = previous
+    return bound
+
+
+class _Stats(object):
+    __slots__ = ('count', 'errors', 'sent', 'received', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.count = self.errors = self.sent = self.received = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, duration, error, sent=0, received=0):
+        self.count += 1
+        self.errors += bool(error)
+        self.sent += sent
+        self.received += received
+        self.seconds += duration
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+
+
+class S3Metrics(object):
+    """ totals per (operation, verb) of s3 requests and per contents operation, and the tracers to call """
+
+    def __init__(self):
+        self.tracers = []
+        self.requests = defaultdict(_Stats)
+        self.operations = defaultdict(_Stats)
+        self._lock = threading.Lock()
+
+    def add_tracer(self, tracer):
+        if isinstance(tracer, string_types):
+            tracer = import_item(tracer)
+        if tracer not in self.tracers:
+            self.tracers.append(tracer)
+
+    def remove_tracer(self, tracer):
+        if tracer in self.tracers:
+            self.tracers.remove(tracer)
+
+    def _trace(self, span):
+        for tracer in self.tracers:
+            try:
+                tracer(span)
+            except Exception:
+                log.exception('tracer %r failed for %r', tracer, span)
+
+    @contextmanager
+    def operation(self, name, **attributes):
+        """ time the contents operation name, nested operations only show up as spans """
+        parent = current_span()
+        span = _local.span = Span(OPERATION, name, parent, **attributes)
+        error = None
+        try:
+            yield span
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _local.span = parent
+            span.finish(error)
+            if parent is None:
+                with self._lock:
+                    self.operations[name].add(span.duration, error)
+            self._trace(span)
+
+    def record_request(self, span):
+        status = span.attributes.get('status')
+        error = span.error is not None or status is None or status >= 400
+        with self._lock:
+            self.requests[(span.operation or '', span.name)].add(
+                span.duration, error, span.attributes.get('bytes_sent', 0), span.attributes.get('bytes_received', 0))
+        self._trace(span)
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.operations.clear()
+
+    def render(self):
+        """ the totals in prometheus' text exposition format """
+        with self._lock:
+            requests = sorted((k, v) for k, v in self.requests.items())
+            operations = sorted(self.operations.items())
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label = ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                lines.append('%s%s{%s} %s' % (name, suffix, label, value))
+
+        def histogram(labels, stats):
+            for bound, count in zip(BUCKETS, stats.buckets):
+                yield '_bucket', labels + [('le', repr(bound))], count
+            yield '_bucket', labels + [('le', '+Inf')], stats.count
+            yield '_sum', labels, repr(stats.seconds)
+            yield '_count', labels, stats.count
+
+        def request_labels(operation, verb):
+            return [('operation', operation), ('verb', verb)]
+
+        metric('s3nb_s3_requests_total', 'counter', 's3 requests by contents operation and verb.',
+               [('', request_labels(*k), v.count) for k, v in requests])
+        metric('s3nb_s3_request_errors_total', 'counter', 's3 requests that failed or got an error status.',
+               [('', request_labels(*k), v.errors) for k, v in requests])
+        metric('s3nb_s3_request_bytes_total', 'counter', 'Bytes sent to and received from s3.',
+               [('', request_labels(*k) + [('direction', d)], n)
+                for k, v in requests for d, n in (('sent', v.sent), ('received', v.received))])
+        metric('s3nb_s3_request_seconds', 'histogram', 'Time until s3 responded.',
+               [sample for k, v in requests for sample in histogram(request_labels(*k), v)])
+        metric('s3nb_operations_total', 'counter', 'Contents operations.',
+               [('', [('operation', k)], v.count) for k, v in operations])
+        metric('s3nb_operation_errors_total', 'counter', 'Contents operations that raised.',
+               [('', [('operation', k)], v.errors) for k, v in operations])
+        metric('s3nb_operation_seconds', 'histogram', 'Duration of contents operations.',
+               [sample for k, v in operations for sample in histogram([('operation', k)], v)])
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = S3Metrics()
+
+
+def traced(name):
+    """ decorate a manager method as the contents operation name """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with METRICS.operation(name):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def request_verb(method, key, headers, query_args):
+    """ the verb a boto request counts as """
+    query_args = query_args or ''
+    if method == 'GET':
+        return 'GET' if key else 'LIST'
+    if method == 'PUT' and any(h.lower() == 'x-amz-copy-source' for h in headers or {}):
+        return 'COPY'
+    if method == 'POST':
+        # multi-object delete, or starting and completing multipart uploads
+        return 'DELETE' if 'delete' in query_args else 'PUT'
+    return method
+
+
+def _content_length(headers):
+    for name, value in (headers or {}).items():
+        if name.lower() == 'content-length':
+            return int(value)
+    return None
+
+
+def instrument(connection):
+    """ record every request made through the boto S3Connection connection """
+    make_request = connection.make_request
+
+    def instrumented(method, bucket='', key='', headers=None, data='', query_args=None, *args, **kwargs):
+        sent = _content_length(headers)
+        if sent is None:
+            sent = len(data) if isinstance(data, (bytes, type(u''))) else 0
+        span = Span(REQUEST, request_verb(method, key, headers, query_args), current_span(),
+                    bucket=getattr(bucket, 'name', bucket), key=getattr(key, 'name', key),
+                    bytes_sent=sent, bytes_received=0, status=None)
+        error = None
+        try:
+            response = make_request(method, bucket, key, headers, data, query_args, *args, **kwargs)
+            span.attributes['status'] = response.status
+            if method != 'HEAD':
+                span.attributes['bytes_received'] = int(response.getheader('content-length') or 0)
+            return response
+        except Exception as e:
+            error = e
+            span.attributes['status'] = getattr(e, 'status', None)
+            raise
+        finally:
+            span.finish(error)
+            METRICS.record_request(span)
+
+    connection.make_request = instrumented
+    return connection
+
+
+class MetricsHandler(IPythonHandler):
+
+    @web.authenticated
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(METRICS.render())
+
+
+def load_jupyter_server_extension(nbapp):
+    from IPython.html.utils import url_path_join
+    web_app = nbapp.web_app
+    route = url_path_join(web_app.settings['base_url'], '/s3nb/metrics')
+    web_app.add_handlers('.*$', [(route, MetricsHandler)])
+    nbapp.log.info('Serving s3nb metrics at %s', route)
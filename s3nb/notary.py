@@ -0,0 +1,44 @@
+"""
+A NotebookNotary that signs and checks notebooks from any thread.
+
+IPython's notary opens its sqlite database on the first thread to use it
+and refuses every other, but S3ContentsManager reads and saves notebooks
+on its executor threads when s3nb.handlers is loaded.
+"""
+import threading
+
+from IPython.nbformat import sign
+from IPython.nbformat.sign import NotebookNotary
+
+
+class S3NotebookNotary(NotebookNotary):
+    """ NotebookNotary sharing one sqlite connection between threads, one at a time """
+
+    def __init__(self, **kwargs):
+        super(S3NotebookNotary, self).__init__(**kwargs)
+        self._lock = threading.RLock()
+
+    def _db_default(self):
+        if sign.sqlite3 is None:
+            return super(S3NotebookNotary, self)._db_default()
+        db = sign.sqlite3.connect(
+            self.db_file, check_same_thread=False,
+            detect_types=sign.sqlite3.PARSE_DECLTYPES | sign.sqlite3.PARSE_COLNAMES)
+        self.init_db(db)
+        return db
+
+    def check_signature(self, nb):
+        with self._lock:
+            return super(S3NotebookNotary, self).check_signature(nb)
+
+    def store_signature(self, signature, nb):
+        with self._lock:
+            return super(S3NotebookNotary, self).store_signature(signature, nb)
+
+    def unsign(self, nb):
+        with self._lock:
+            return super(S3NotebookNotary, self).unsign(nb)
+
+    def cull_db(self):
+        with self._lock:
+            return super(S3NotebookNotary, self).cull_db()
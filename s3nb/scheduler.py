@@ -0,0 +1,232 @@
+"""
+Rate limits, priorities and throttling retries for every s3 request.
+
+Every pooled connection sends its requests through SCHEDULER, which
+  * makes them wait for a token from a bucket per key prefix, one for
+    reads and one for writes, starting at s3's documented per-prefix rates;
+  * hands out tokens, and s3 executor threads, to notebook and file opens
+    first, then everything else, then saves and listings;
+  * retries a 503 SlowDown after a jittered, exponentially growing delay
+    and halves the prefix's rate, which recovers while requests succeed.
+
+A request still throttled after s3_throttle_retries retries raises an
+S3ResponseError with status 503, which the managers report as a 503.
+
+c.S3ContentsManager.s3_rate_limit_reads = 5500
+c.S3ContentsManager.s3_rate_limit_writes = 3500
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from boto.compat import parse_qs
+from boto.exception import S3ResponseError
+
+from .metrics import current_span, request_verb
+
+
+# lower runs first
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+# operations a user is waiting on, and ones nobody is watching
+INTERACTIVE_OPERATIONS = ('get', 'get_notebook')
+BACKGROUND_OPERATIONS = ('save', 'save_notebook', 'update_notebook', 'write_behind', 'create_checkpoint')
+
+READ_VERBS = ('GET', 'HEAD', 'LIST')
+
+# how quickly a throttled prefix's rate grows back, as a fraction of its limit per second
+RECOVERY = 0.05
+# throttles this close together count as one when halving the rate
+THROTTLE_WINDOW = 1.0
+MIN_RATE = 1.0
+
+THROTTLED_MESSAGE = u's3 is throttling requests, try again shortly'
+
+log = logging.getLogger(__name__)
+
+
+def operation_priority(span):
+    """ the priority of work done for the operation span belongs to """
+    operation = span.operation if span is not None else None
+    if operation in INTERACTIVE_OPERATIONS:
+        return INTERACTIVE
+    if operation in BACKGROUND_OPERATIONS:
+        return BACKGROUND
+    return NORMAL
+
+
+def request_priority(span, verb):
+    """ the priority of an s3 request with verb made for the operation span belongs to """
+    if verb == 'LIST':
+        return BACKGROUND
+    priority = operation_priority(span)
+    if priority == INTERACTIVE and verb not in READ_VERBS:
+        # e.g. writing a manifest while listing a folder
+        return NORMAL
+    return priority
+
+
+def is_throttled(e):
+    return isinstance(e, S3ResponseError) and e.status == 503
+
+
+class Throttled(S3ResponseError):
+    """ a 503 from s3, raised out of boto's own retry loop so the scheduler retries it """
+
+
+class TokenBucket(object):
+    """
+    rate tokens a second, up to a second's worth saved up, taken by waiters
+    in priority order.  The rate halves when throttled and grows back by
+    RECOVERY of max_rate a second while requests succeed.
+    """
+
+    def __init__(self, rate, clock=time.time):
+        self.max_rate = self.rate = max(float(rate), MIN_RATE)
+        self.clock = clock
+        self.tokens = self.rate
+        self.updated = self.adjusted = clock()
+        self.throttled_at = None
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=NORMAL):
+        """ wait for a token, returns the seconds waited """
+        start = self.clock()
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    if self._waiting[0] == ticket:
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            return self.clock() - start
+                        # only the first in line watches the clock, the rest wait their turn
+                        self._cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def throttled(self):
+        with self._cond:
+            now = self.clock()
+            if self.throttled_at is not None and now - self.throttled_at < THROTTLE_WINDOW:
+                return
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, self.rate)
+            self.throttled_at = self.adjusted = now
+
+    def succeeded(self):
+        if self.rate >= self.max_rate:
+            return
+        with self._cond:
+            now = self.clock()
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY * (now - self.adjusted))
+            self.adjusted = now
+
+
+class S3Scheduler(object):
+    """
+    Token buckets by (bucket, key prefix, reads or writes) and the retry
+    policy for throttled requests.  Prefixes are the first prefix_depth
+    components of a key, or of a listing's prefix.
+    """
+
+    def __init__(self, read_rate=5500, write_rate=3500, prefix_depth=1, delimiter='/',
+                 retries=8, backoff_base=0.05, backoff_max=20.0, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.configure(read_rate, write_rate, prefix_depth, delimiter, retries, backoff_base, backoff_max)
+
+    def configure(self, read_rate=5500, write_rate=3500, prefix_depth=1, delimiter='/',
+                  retries=8, backoff_base=0.05, backoff_max=20.0):
+        """ change the limits, token buckets start over with the new rates """
+        with self._lock:
+            self.read_rate = read_rate
+            self.write_rate = write_rate
+            self.prefix_depth = prefix_depth
+            self.delimiter = delimiter
+            self.retries = retries
+            self.backoff_base = backoff_base
+            self.backoff_max = backoff_max
+            self._buckets = {}
+
+    def prefix(self, key, query_args=None):
+        name = getattr(key, 'name', key) or ''
+        if not name and query_args:
+            name = (parse_qs(query_args).get('prefix') or [''])[0]
+        return self.delimiter.join(name.split(self.delimiter)[:self.prefix_depth])
+
+    def token_bucket(self, bucket, prefix, verb):
+        read = verb in READ_VERBS
+        limit = (bucket, prefix, read)
+        with self._lock:
+            tb = self._buckets.get(limit)
+            if tb is None:
+                tb = self._buckets[limit] = TokenBucket(self.read_rate if read else self.write_rate, self.clock)
+            return tb
+
+    def backoff(self, attempt):
+        """ full jitter: anywhere up to an exponentially growing cap """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def schedule(self, connection):
+        """ send every request made through the boto S3Connection connection through the scheduler """
+        make_request = connection.make_request
+
+        def scheduled(method, bucket='', key='', headers=None, data='', query_args=None,
+                      sender=None, override_num_retries=None, retry_handler=None):
+            verb = request_verb(method, key, headers, query_args)
+            priority = request_priority(current_span(), verb)
+            tb = self.token_bucket(getattr(bucket, 'name', bucket), self.prefix(key, query_args), verb)
+
+            def throttle(response, i, next_sleep):
+                # boto would retry a 503 at once on its own schedule, take it back
+                if response.status == 503:
+                    raise Throttled(response.status, response.reason, response.read())
+                if callable(retry_handler):
+                    return retry_handler(response, i, next_sleep)
+
+            attempt = 0
+            while True:
+                tb.acquire(priority)
+                try:
+                    response = make_request(method, bucket, key, headers, data, query_args,
+                                            sender, override_num_retries, throttle)
+                except Throttled:
+                    tb.throttled()
+                    if attempt >= self.retries:
+                        raise
+                    delay = self.backoff(attempt)
+                    attempt += 1
+                    log.warning('s3 throttled %s %s, retry %d of %d in %.2fs',
+                                verb, getattr(key, 'name', key), attempt, self.retries, delay)
+                    self.sleep(delay)
+                    continue
+                tb.succeeded()
+                return response
+
+        connection.make_request = scheduled
+        return connection
+
+
+SCHEDULER = S3Scheduler()
@@ -0,0 +1,37 @@
+"""
+Log arguments that stand in for notebook and file payloads.
+
+    self.log.debug('save: %s %s', path, summarize(model))
+
+logs the model with its content replaced by its size and digest.  Nothing
+is serialized or hashed unless the message is actually emitted.
+"""
+import hashlib
+import json
+
+
+def _digest(data):
+    if not isinstance(data, bytes):
+        if not isinstance(data, type(u'')):
+            data = json.dumps(data, sort_keys=True, default=repr)
+        data = data.encode('utf-8')
+    return '<%d bytes sha1:%s>' % (len(data), hashlib.sha1(data).hexdigest()[:12])
+
+
+class summarize(object):
+    """ formats value with any content replaced by its size and digest """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, dict) and 'content' in value:
+            value = dict(value)
+            if value['content'] is not None:
+                value['content'] = _digest(value['content'])
+            return repr(value)
+        return _digest(value)
+
+    __repr__ = __str__
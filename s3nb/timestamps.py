@@ -0,0 +1,66 @@
+"""
+Parsing of the two fixed timestamp formats s3 uses, without strptime.
+"""
+import datetime
+
+from IPython.utils import tz
+
+
+# s3 return different time formats in different situations apparently
+S3_TIMEFORMAT_GET_KEY = '%a, %d %b %Y %H:%M:%S GMT'
+S3_TIMEFORMAT_BUCKET_LIST = '%Y-%m-%dT%H:%M:%S.000Z'
+
+MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+_MEMO_SIZE = 4096
+_memo = {}
+
+
+try:
+    _fromisoformat = datetime.datetime.fromisoformat
+except AttributeError:  # python < 3.7
+    _fromisoformat = None
+
+
+def _parse_bucket_list(value):
+    # 2015-01-31T12:34:56.000Z
+    if _fromisoformat is not None:
+        # parsing the offset is cheaper than attaching a tzinfo afterwards
+        return _fromisoformat(value[:19] + '+00:00')
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]), tzinfo=tz.UTC)
+
+
+def _parse_get_key(value):
+    # Sat, 31 Jan 2015 12:34:56 GMT
+    return datetime.datetime(
+        int(value[12:16]), MONTHS[value[8:11]], int(value[5:7]),
+        int(value[17:19]), int(value[20:22]), int(value[23:25]), tzinfo=tz.UTC)
+
+
+_PARSERS = {
+    S3_TIMEFORMAT_BUCKET_LIST: _parse_bucket_list,
+    S3_TIMEFORMAT_GET_KEY: _parse_get_key,
+}
+
+
+def parse_s3_time(value, timeformat):
+    """ the UTC datetime value in timeformat stands for """
+    parsed = _memo.get((value, timeformat))
+    if parsed is not None:
+        return parsed
+    try:
+        parsed = _PARSERS[timeformat](value)
+    except (KeyError, ValueError, IndexError):
+        parsed = datetime.datetime.strptime(value, timeformat).replace(tzinfo=tz.UTC)
+    # keys written together share timestamps, and datetimes are immutable
+    if len(_memo) >= _MEMO_SIZE:
+        _memo.clear()
+    _memo[(value, timeformat)] = parsed
+    return parsed
+
+
+def utcnow():
+    return datetime.datetime.now(tz.UTC)
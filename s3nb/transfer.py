@@ -0,0 +1,151 @@
+"""
+Multipart uploads, ranged parallel downloads and other parallel s3 fan-out.
+"""
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import os
+
+import boto.s3.key
+
+from .metrics import bind
+
+
+MB = 1024 * 1024
+
+uploaded = namedtuple('uploaded', 'etag last_modified')
+
+
+class UploadKey(boto.s3.key.Key):
+    """ a Key that keeps the time s3 gave the object it uploaded, as the Last-Modified or Date of the PUT """
+
+    def handle_addl_headers(self, headers):
+        headers = dict((name.lower(), value) for name, value in headers)
+        self.last_modified = headers.get('last-modified') or headers.get('date') or self.last_modified
+
+
+class S3Transfer(object):
+    """
+    Moves objects of at least threshold bytes in part_size pieces.  All
+    transfers share one pool of concurrency threads, so that many parts are
+    in flight across all of them at once.  Each part is retried on its own up
+    to retries times before the whole transfer is abandoned.
+    """
+
+    def __init__(self, threshold=64 * MB, part_size=16 * MB, concurrency=4, retries=3, log=None):
+        # s3 rejects multipart parts smaller than 5MB
+        self.part_size = max(part_size, 5 * MB)
+        self.threshold = max(threshold, self.part_size)
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.log = log or logging.getLogger(__name__)
+        self._pool = ThreadPoolExecutor(self.concurrency)
+
+    def _retry(self, what, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                self.log.warning('%s failed (attempt %d of %d): %s', what, attempt, self.retries + 1, e)
+
+    @staticmethod
+    def _size(fp):
+        pos = fp.tell()
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell() - pos
+        fp.seek(pos)
+        return size
+
+    def _bounded(self, tasks, consume):
+        """ submit tasks in order, at most concurrency at a time, passing results to consume in order """
+        pending = deque()
+        for task in tasks:
+            pending.append(self._pool.submit(bind(task[0]), *task[1:]))
+            if len(pending) >= self.concurrency:
+                consume(pending.popleft().result())
+        while pending:
+            consume(pending.popleft().result())
+
+    def map(self, func, items):
+        """ func(item) for each item with up to concurrency calls in flight, results in order """
+        results = []
+        self._bounded(((func, item) for item in items), results.append)
+        return results
+
+    def upload(self, bucket, key_name, fp, size=None, headers=None):
+        """ upload fp from its current position to key_name, returning its uploaded etag and last_modified """
+        if size is None:
+            size = self._size(fp)
+        if size < self.threshold:
+            k = UploadKey(bucket, key_name)
+            k.set_contents_from_file(fp, headers=headers)
+            return uploaded(k.etag, k.last_modified)
+
+        # preconditions apply to the request that creates the object, which is the completion
+        headers = dict(headers or {})
+        conditions = dict((h, headers.pop(h)) for h in ('If-Match', 'If-None-Match') if h in headers)
+        mp = bucket.initiate_multipart_upload(key_name, headers=headers)
+        self.log.debug('upload: %s bytes to %s in %s byte parts', size, key_name, self.part_size)
+
+        def parts():
+            part_num = 0
+            while True:
+                data = fp.read(self.part_size)
+                if not data:
+                    return
+                part_num += 1
+                yield (self._upload_part, mp, part_num, data)
+
+        try:
+            self._bounded(parts(), lambda _: None)
+            etag = bucket.complete_multipart_upload(key_name, mp.id, mp.to_xml(), headers=conditions).etag
+        except Exception:
+            mp.cancel_upload()
+            raise
+        # the completion doesn't say when, only a HEAD does
+        try:
+            k = bucket.get_key(key_name)
+        except Exception as e:
+            self.log.warning('upload: could not read back the time of %s: %s', key_name, e)
+            k = None
+        return uploaded(etag, k.last_modified if k is not None and k.etag == etag else None)
+
+    def _upload_part(self, mp, part_num, data):
+        return self._retry(
+            'upload of part %d of %s' % (part_num, mp.key_name),
+            lambda: mp.upload_part_from_file(io.BytesIO(data), part_num, size=len(data)))
+
+    def download(self, k, fp, limit=None):
+        """ write the body of k, or only its first limit bytes if limit is given, into fp """
+        size = k.size if not limit or k.size is None else min(k.size, limit)
+        if size is None or size < self.threshold:
+            if size is not None and size < k.size:
+                k.get_file(fp, headers={'Range': 'bytes=0-%d' % (size - 1)})
+            else:
+                k.get_file(fp)
+            return
+
+        self.log.debug('download: %s of %s bytes from %s in %s byte ranges', size, k.size, k.name, self.part_size)
+        ranges = ((self.read_range, k.bucket, k.name, start, min(start + self.part_size, size) - 1, k.etag)
+                  for start in range(0, size, self.part_size))
+        self._bounded(ranges, fp.write)
+
+    def read_range(self, bucket, key_name, start, end, etag=None):
+        """ bytes start to end inclusive of key_name, failing if it no longer has etag """
+        def fetch():
+            buf = io.BytesIO()
+            headers = {'Range': 'bytes=%d-%d' % (start, end)}
+            # fail rather than stitch together ranges of different versions
+            if etag:
+                headers['If-Match'] = etag
+            boto.s3.key.Key(bucket, key_name).get_file(buf, headers=headers)
+            return buf.getvalue()
+        return self._retry('download of bytes %d-%d of %s' % (start, end, key_name), fetch)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
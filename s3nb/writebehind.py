@@ -0,0 +1,320 @@
+"""
+Notebook saves that return once they are on local disk and reach s3 in the background.
+
+c.S3ContentsManager.s3_write_behind = True
+c.S3ContentsManager.s3_write_behind_dir = '/var/lib/s3nb/journal'
+
+journals each save of a notebook the server has already read or written
+to s3_write_behind_dir, fsynced, and returns.  A flusher thread uploads it
+s3_write_behind_delay seconds later; saves of the same notebook made in
+the meantime replace it, so a burst of autosaves costs one PUT of the
+newest version.  At most s3_write_behind_max_pending notebooks wait at
+once, a save beyond that waits for room and is otherwise written directly.
+Everything pending is flushed when the server exits, and whatever a crash
+left in the journal is uploaded when it starts again.  Give each server
+its own directory.
+"""
+import atexit
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+JOURNAL_SUFFIX = '.journal'
+CONFLICT_SUFFIX = '.conflict'
+
+
+class Conflict(Exception):
+    """ raised by a flush when the key changed in s3 since the save it holds was based on it """
+
+
+class Pending(object):
+    """
+    The newest save of key not yet in s3: data is the body to upload with
+    headers, etag the version it was based on, and last_modified when it
+    was made, in S3_TIMEFORMAT_GET_KEY.
+    """
+    __slots__ = ('namespace', 'key', 'path', 'data', 'headers', 'etag', 'last_modified', 'seq', 'due', 'attempts')
+
+    def __init__(self, namespace, key, path, data, headers=None, etag=None, last_modified=None):
+        self.namespace = namespace
+        self.key = key
+        self.path = path
+        self.data = data
+        self.headers = dict(headers or {})
+        self.etag = etag
+        self.last_modified = last_modified
+        self.seq = None
+        self.due = None
+        self.attempts = 0
+
+    def header(self):
+        return json.dumps({
+            'namespace': self.namespace, 'key': self.key, 'path': self.path, 'headers': self.headers,
+            'etag': self.etag, 'last_modified': self.last_modified,
+        }, sort_keys=True).encode('utf-8')
+
+    @classmethod
+    def load(cls, f):
+        header = json.loads(f.readline().decode('utf-8'))
+        return cls(header['namespace'], header['key'], header['path'], f.read(),
+                   header['headers'], header['etag'], header['last_modified'])
+
+
+def _register_exit(func):
+    # python 3.9+ stops thread pools before atexit handlers run, flush while they still work
+    getattr(threading, '_register_atexit', atexit.register)(func)
+
+
+class WriteBehindQueue(object):
+    """
+    Pending saves by key, journaled in directory and handed to flush(pending)
+    on a background thread.  flush raises Conflict when the save can never
+    be written, which keeps its journal as a .conflict file, and anything
+    else to be retried with exponential backoff.
+    """
+
+    def __init__(self, directory, flush, namespace='', max_pending=100, delay=2.0, max_backoff=60.0, log=None):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.flush = flush
+        self.namespace = namespace
+        self.max_pending = max(max_pending, 1)
+        self.delay = delay
+        self.max_backoff = max_backoff
+        self.log = log or logging.getLogger(__name__)
+        # keys whose last flush conflicted, saved directly until they are read again
+        self.conflicts = set()
+        self._pending = {}
+        self._reserved = 0
+        self._flushing = None
+        self._abandoned = set()
+        self._seq = itertools.count(1)
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='s3nb-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        _register_exit(self.close)
+
+    def _path(self, key):
+        digest = hashlib.sha1(u'{0}\0{1}'.format(self.namespace, key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + JOURNAL_SUFFIX)
+
+    def _sync_directory(self):
+        """ make renames in the journal durable """
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, pending):
+        """ the name of a fsynced temporary file holding pending """
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pending.header() + b'\n')
+                f.write(pending.data)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception:
+            os.remove(tmp)
+            raise
+        return tmp
+
+    def put(self, key, path, data, headers=None, etag=None, last_modified=None, timeout=None):
+        """
+        Journal a save of key, replacing any still pending, and return True.
+        Returns False without journaling if the queue stayed full for timeout
+        seconds or is closed, the caller should then write it directly.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while (not self._closed and key not in self._pending
+                    and len(self._pending) + self._reserved >= self.max_pending):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            if self._closed:
+                return False
+            pending = Pending(self.namespace, key, path, data, headers, etag, last_modified)
+            pending.seq = next(self._seq)
+            self._reserved += 1
+        try:
+            # the fsync happens outside the lock so saves of other notebooks don't queue behind it
+            tmp = self._write(pending)
+            with self._cond:
+                current = self._pending.get(key)
+                if current is not None and current.seq > pending.seq:
+                    # a newer save of the same notebook got in first
+                    os.remove(tmp)
+                    return True
+                os.rename(tmp, self._path(key))
+                # coalescing never postpones a flush, the first save of a burst sets when it happens
+                pending.due = current.due if current is not None else time.time() + self.delay
+                self._pending[key] = pending
+                self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._reserved -= 1
+        self._sync_directory()
+        return True
+
+    def get(self, key):
+        """ the Pending save of key, or None """
+        with self._cond:
+            return self._pending.get(key)
+
+    def resolved(self, key):
+        """ key was read again, so its saves can be written behind once more """
+        self.conflicts.discard(key)
+
+    def replay(self):
+        """ queue the saves a previous process journaled but never flushed, returns how many """
+        count = 0
+        for name in sorted(os.listdir(self.directory)):
+            filename = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                # never acknowledged, the save that was writing it failed or never returned
+                os.remove(filename)
+                continue
+            if not name.endswith(JOURNAL_SUFFIX):
+                continue
+            try:
+                with open(filename, 'rb') as f:
+                    pending = Pending.load(f)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                self.log.warning('write-behind: skipping unreadable journal %s: %s', filename, e)
+                continue
+            if pending.namespace != self.namespace:
+                continue
+            with self._cond:
+                if pending.key in self._pending:
+                    continue
+                pending.seq = next(self._seq)
+                pending.due = time.time()
+                self._pending[pending.key] = pending
+                self._cond.notify_all()
+            count += 1
+        if count:
+            self.log.info('write-behind: replaying %d saves journaled in %s', count, self.directory)
+        return count
+
+    def _next(self):
+        """ the next Pending to flush, waiting until one is due, or None once closed and drained """
+        while True:
+            waiting = [p for p in self._pending.values() if p.key not in self._abandoned]
+            if not waiting:
+                if self._closed:
+                    return None
+                self._cond.wait()
+                continue
+            pending = min(waiting, key=lambda p: p.due)
+            now = time.time()
+            if self._closed or pending.due <= now:
+                return pending
+            self._cond.wait(pending.due - now)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                pending = self._next()
+                if pending is None:
+                    return
+                self._flushing = pending.key
+            try:
+                self._flush(pending)
+            except Exception:
+                # nothing a flush does wrong may stop the thread that flushes every other save
+                self.log.exception('write-behind: flushing %s failed', pending.key)
+                with self._cond:
+                    pending.due = time.time() + self.max_backoff
+            finally:
+                with self._cond:
+                    self._flushing = None
+                    self._cond.notify_all()
+
+    def _flush(self, pending):
+        try:
+            self.flush(pending)
+        except Conflict as e:
+            self.conflicts.add(pending.key)
+            self._done(pending, conflict=True)
+            self.log.error('write-behind: not saving %s: %s', pending.key, e)
+        except Exception as e:
+            with self._cond:
+                pending.attempts += 1
+                if self._closed:
+                    self._abandoned.add(pending.key)
+                else:
+                    pending.due = time.time() + min(self.max_backoff, self.delay * 2 ** pending.attempts)
+            if self._closed:
+                self.log.error('write-behind: %s not saved to s3, it stays in %s: %s',
+                               pending.key, self._path(pending.key), e)
+            else:
+                self.log.warning('write-behind: saving %s failed %d times, retrying: %s',
+                                 pending.key, pending.attempts, e)
+        else:
+            self._done(pending)
+
+    def _done(self, pending, conflict=False):
+        with self._cond:
+            # a newer save of the key keeps its journal and stays pending
+            if self._pending.get(pending.key) is pending:
+                del self._pending[pending.key]
+                filename = self._path(pending.key)
+                try:
+                    if conflict:
+                        kept = filename[:-len(JOURNAL_SUFFIX)] + '-%d%s' % (time.time(), CONFLICT_SUFFIX)
+                        os.rename(filename, kept)
+                        self.log.error('write-behind: the unsaved version of %s is kept in %s', pending.key, kept)
+                    else:
+                        os.remove(filename)
+                except OSError as e:
+                    # e.g. another process sharing the directory got to it first
+                    self.log.error('write-behind: could not clear the journal of %s in %s: %s',
+                                   pending.key, filename, e)
+            self._cond.notify_all()
+
+    def flush_prefix(self, prefix, timeout=None):
+        """
+        Upload the pending saves of keys starting with prefix now.  Returns
+        the keys still pending when one failed or timeout ran out.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            attempts = dict((k, p.attempts) for k, p in self._pending.items() if k.startswith(prefix))
+            if self._flushing is not None and self._flushing.startswith(prefix):
+                attempts.setdefault(self._flushing, 0)
+            for key in attempts:
+                if key in self._pending:
+                    self._pending[key].due = 0
+            self._cond.notify_all()
+            while True:
+                left = [k for k in attempts if k in self._pending or k == self._flushing]
+                if not left:
+                    return []
+                if any(k in self._pending and self._pending[k].attempts > attempts[k] for k in left):
+                    return left
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return left
+                self._cond.wait(remaining)
+
+    def close(self, timeout=None):
+        """ flush everything pending and stop, saves that fail now stay journaled for the next start """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
@@ -1,15 +1,22 @@
+import sys
+
 try:
     from setuptools import setup
 except ImportError:
     from distutils.core import setup
 
+install_requires = ['ipython[notebook]>=2.0', 'boto>=2.38,<3']
+if sys.version_info < (3, 2):
+    install_requires.append('futures')
+
 setup(
     name = 's3nb',
     version = '0.0.5',
     author = "Monetate Inc.",
     author_email = "graphaelli@monetate.com",
     description = "s3 backed notebook manager for ipython 2.0+",
-    install_requires = ['ipython[notebook]>=2.0', 'boto'],
+    install_requires = install_requires,
+    extras_require = {'zstd': ['zstandard']},
     keywords = "ipython",
     license = "Python",
     long_description = """This package enables storage of ipynb files in s3""",
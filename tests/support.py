@@ -0,0 +1,88 @@
+"""
+Shared helpers for tests that run S3ContentsManager against moto's in-process s3.
+"""
+import time
+import unittest
+
+try:
+    from moto import mock_s3_deprecated
+except ImportError:  # moto<2 provides the boto 2 mock
+    mock_s3_deprecated = None
+
+BUCKET = 'bkt'
+PREFIX = 'pre/'
+
+
+def needs_moto(cls):
+    return unittest.skipIf(mock_s3_deprecated is None, 'needs moto<2')(cls)
+
+
+class S3TestCase(unittest.TestCase):
+    """ a fresh mocked bucket for each test, make() builds managers on it """
+
+    def setUp(self):
+        self.mock = mock_s3_deprecated()
+        self.mock.start()
+        import boto
+        self.bucket = boto.connect_s3().create_bucket(BUCKET)
+        self.managers = []
+
+    def tearDown(self):
+        for cm in self.managers:
+            if cm._write_behind is not None:
+                cm._write_behind.close(5)
+            cm.s3_executor.shutdown()
+        self.mock.stop()
+
+    def make(self, **config):
+        from IPython.config import Config
+        from s3nb.connection import S3ConnectionPool
+        from s3nb.ipy3 import S3ContentsManager
+        # pooled connections would outlive this test's mock
+        S3ConnectionPool._shared.clear()
+        config.setdefault('s3_base_uri', 's3://%s/%s' % (BUCKET, PREFIX))
+        config.setdefault('s3_transfer_concurrency', 1)
+        cm = S3ContentsManager(config=Config({
+            'S3ContentsManager': config,
+            'NotebookNotary': {'secret': b'secret', 'db_file': ':memory:'},
+        }))
+        self.managers.append(cm)
+        return cm
+
+    def put(self, name, data, **headers):
+        """ write a key behind the managers' backs """
+        k = self.bucket.new_key(PREFIX + name)
+        k.set_contents_from_string(data, headers=headers or None)
+        return k
+
+
+class FakeClock(object):
+    """ a clock that only moves when told to """
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out waiting for %s' % condition)
+        time.sleep(0.01)
+
+
+def notebook(source='print(1)'):
+    from IPython import nbformat
+    nb = nbformat.v4.new_notebook()
+    nb.cells.append(nbformat.v4.new_code_cell(source))
+    return nb
+
+
+def notebook_model(source='print(1)'):
+    return {'type': 'notebook', 'content': notebook(source)}
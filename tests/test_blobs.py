@@ -0,0 +1,61 @@
+import unittest
+
+from IPython import nbformat
+
+from s3nb import blobs
+from support import S3TestCase, needs_moto, notebook, notebook_model
+
+
+def with_output(nb, text):
+    nb.cells[0].outputs.append(nbformat.v4.new_output('display_data', {'text/plain': text}))
+    return nb
+
+
+class BlobsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        nb = with_output(notebook(), u'y' * 100)
+        nb.cells[0].outputs[0].data['image/png'] = u'small'
+        extracted = blobs.extract(nb, 10)
+        self.assertEqual(list(extracted.values()), [b'y' * 100])
+        self.assertEqual(nb.cells[0].outputs[0].data['text/plain'], blobs.REF_PREFIX + list(extracted)[0])
+        self.assertEqual(nb.cells[0].outputs[0].data['image/png'], u'small')
+        self.assertEqual(blobs.references(nb), set(extracted))
+        blobs.restore(nb, extracted)
+        self.assertEqual(nb.cells[0].outputs[0].data['text/plain'], u'y' * 100)
+        self.assertEqual(blobs.references(nb), set())
+
+
+@needs_moto
+class SweepTest(S3TestCase):
+
+    def blob_keys(self):
+        return [k.name for k in self.bucket.list('pre/' + blobs.BLOB_DIR + '/')]
+
+    def test_shared_blobs_go_with_their_last_notebook(self):
+        cm = self.make(s3_output_blobs=True, s3_blob_min_size=10, s3_compression='gzip')
+        for name in ('a.ipynb', 'b.ipynb'):
+            cm.save({'type': 'notebook', 'content': with_output(notebook(), u'y' * 100)}, name)
+        cm.save(notebook_model(), 'c.ipynb')
+        self.assertEqual(len(self.blob_keys()), 1)
+
+        # too young to go, however unreferenced
+        cm.delete('a.ipynb')
+        cm.delete('b.ipynb')
+        self.assertEqual(blobs.sweep(self.bucket, 'pre/'), [])
+        self.assertEqual(len(self.blob_keys()), 1)
+
+        cm.save({'type': 'notebook', 'content': with_output(notebook(), u'y' * 100)}, 'b.ipynb')
+        self.assertEqual(blobs.sweep(self.bucket, 'pre/', min_age=-60), [])
+        self.assertEqual(len(self.blob_keys()), 1)
+
+        cm.delete('b.ipynb')
+        swept = blobs.sweep(self.bucket, 'pre/', min_age=-60, dry_run=True)
+        self.assertEqual(len(swept), 1)
+        self.assertEqual(len(self.blob_keys()), 1)
+        self.assertEqual(blobs.sweep(self.bucket, 'pre/', min_age=-60), swept)
+        self.assertEqual(self.blob_keys(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
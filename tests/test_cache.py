@@ -0,0 +1,120 @@
+import datetime
+import unittest
+
+from s3nb.cache import MISSING, ContentCache, S3MetadataCache, TTLCache, ancestors, cachedkey
+from support import FakeClock
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_entries_expire(self):
+        cache = TTLCache(10, 100, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.advance(10)
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.advance(0.5)
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertIsNone(cache.get('a', None))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TTLCache(10, 2, clock=self.clock)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_setting_again_restarts_the_ttl(self):
+        cache = TTLCache(10, 100, clock=self.clock)
+        cache.set('a', 1)
+        self.clock.advance(8)
+        cache.set('a', 2)
+        self.clock.advance(8)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_invalidate_prefix(self):
+        cache = TTLCache(10, 100, clock=self.clock)
+        for key in ('a/', 'a/b', 'ab', 'b'):
+            cache.set(key, key)
+        cache.invalidate_prefix('a/')
+        self.assertEqual(sorted(k for k in ('a/', 'a/b', 'ab', 'b') if cache.get(k) is not MISSING), ['ab', 'b'])
+
+    def test_disabled(self):
+        cache = TTLCache(0, 100, clock=self.clock)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+
+
+class ContentCacheTest(unittest.TestCase):
+
+    def key(self, name):
+        return cachedkey(name, 'Sat, 31 Jan 2015 12:34:56 GMT', '"%s"' % name, None, None)
+
+    def test_bounded_by_bytes(self):
+        cache = ContentCache(10)
+        cache.set(self.key('a'), b'x' * 4)
+        cache.set(self.key('b'), b'x' * 4)
+        cache.get('a')
+        cache.set(self.key('c'), b'x' * 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get('a')[0].etag, '"a"')
+
+    def test_too_big_replaces_nothing(self):
+        cache = ContentCache(10)
+        cache.set(self.key('a'), b'x' * 4)
+        cache.set(self.key('a'), b'x' * 11)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+
+
+class S3MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = S3MetadataCache()
+        self.when = datetime.datetime(2015, 1, 31, 12, 34, 56)
+
+    def test_ancestors(self):
+        self.assertEqual(ancestors('a/b/c.ipynb', '/'), ['a/b/', 'a/', ''])
+        self.assertEqual(ancestors('a/b/', '/'), ['a/', ''])
+        self.assertEqual(ancestors('c.ipynb', '/'), [''])
+
+    def test_writes_drop_what_they_change(self):
+        self.cache.listings.set('a/', ['a/b.ipynb'])
+        self.cache.heads.set('a/b.ipynb', None)
+        self.cache.set_last_modified('a/', self.when, self.cache.generation('a/'))
+        self.cache.set_last_modified('c/', self.when, self.cache.generation('c/'))
+        self.cache.invalidate_key('a/b.ipynb')
+        self.assertIs(self.cache.listings.get('a/'), MISSING)
+        self.assertIs(self.cache.heads.get('a/b.ipynb'), MISSING)
+        self.assertIsNone(self.cache.last_modified('a/'))
+        self.assertEqual(self.cache.last_modified('c/'), self.when)
+
+    def test_markers_worked_out_during_a_write_are_not_kept(self):
+        generation = self.cache.generation('a/b/')
+        self.cache.invalidate_key('a/b/c.ipynb')
+        self.cache.set_last_modified('a/b/', self.when, generation)
+        self.assertIsNone(self.cache.last_modified('a/b/'))
+
+        generation = self.cache.generation('a/b/')
+        # everything below a/ went
+        self.cache.invalidate_prefix('a/')
+        self.assertNotEqual(self.cache.generation('a/b/'), generation)
+        generation = self.cache.generation('a/b/')
+        self.cache.invalidate_key('d/e.ipynb')
+        self.cache.invalidate_key('a/b/c/d.ipynb')
+        self.assertNotEqual(self.cache.generation('a/b/'), generation)
+        generation = self.cache.generation('a/b/')
+        self.cache.invalidate_key('d/e.ipynb')
+        self.cache.invalidate_key('a/f.ipynb')
+        self.assertEqual(self.cache.generation('a/b/'), generation)
+        self.cache.clear()
+        self.assertNotEqual(self.cache.generation('a/b/'), generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+from s3nb.executor import S3Executor, TimeoutError
+from s3nb.scheduler import BACKGROUND, INTERACTIVE, NORMAL
+
+
+class S3ExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.executor = S3Executor(max_workers=1)
+
+    def tearDown(self):
+        self.release.set()
+        self.executor.shutdown()
+
+    def occupy(self):
+        """ keep the only worker busy until self.release is set """
+        started = threading.Event()
+
+        def block():
+            started.set()
+            self.release.wait()
+        future = self.executor.submit_as(NORMAL, block)
+        self.assertTrue(started.wait(5))
+        return future
+
+    def test_queued_calls_start_in_priority_order(self):
+        self.occupy()
+        ran = []
+        futures = [self.executor.submit_as(priority, ran.append, name) for name, priority in (
+            ('save', BACKGROUND), ('list', NORMAL), ('open', INTERACTIVE), ('rename', NORMAL))]
+        self.release.set()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(ran, ['open', 'list', 'rename', 'save'])
+
+    def test_calls_that_never_start_time_out(self):
+        self.executor.timeout = 0.05
+        self.occupy()
+        ran = []
+        with self.assertRaises(TimeoutError):
+            self.executor.call(ran.append, 'late')
+        self.release.set()
+        self.executor.submit_as(BACKGROUND, lambda: None).result(5)
+        self.assertEqual(ran, [])
+
+    def test_calls_from_the_pool_run_inline(self):
+        self.executor.timeout = 0.05
+
+        def nested():
+            # the only worker is this thread, queueing it would time out
+            return self.executor.call(threading.current_thread)
+        self.assertEqual(self.executor.submit_as(NORMAL, nested).result(5).name, 's3nb-executor-0')
+
+    def test_no_workers_runs_inline(self):
+        executor = S3Executor(max_workers=0)
+        self.assertIs(executor.call(threading.current_thread), threading.current_thread())
+        self.assertIs(executor.submit_as(BACKGROUND, threading.current_thread).result(), threading.current_thread())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import datetime
+import shutil
+import tempfile
+import time
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from IPython import nbformat
+from tornado import web
+
+from s3nb.timestamps import S3_TIMEFORMAT_GET_KEY, parse_s3_time
+from support import S3TestCase, needs_moto, notebook_model, wait_for
+
+
+@needs_moto
+class FilePreviewTest(S3TestCase):
+
+    def test_large_files_open_read_only(self):
+        cm = self.make(s3_file_preview_size=10)
+        self.put('big.txt', b'x' * 100)
+        self.assertFalse(cm.get('big.txt', content=False)['writable'])
+        model = cm.get('big.txt')
+        self.assertFalse(model['writable'])
+        self.assertEqual(model['content'], u'x' * 10)
+        self.put('small.txt', b'y')
+        self.assertTrue(cm.get('small.txt')['writable'])
+
+    def test_saving_a_preview_fails(self):
+        cm = self.make(s3_file_preview_size=10)
+        self.put('big.txt', b'x' * 100)
+        model = cm.get('big.txt')
+        with self.assertRaises(web.HTTPError) as e:
+            cm.save(model, 'big.txt')
+        self.assertEqual(e.exception.status_code, 403)
+        self.assertEqual(self.bucket.get_key('pre/big.txt').size, 100)
+
+    def test_a_replaced_preview_can_be_saved(self):
+        cm = self.make(s3_file_preview_size=10, s3_conditional_saves=False)
+        self.put('big.txt', b'x' * 100)
+        cm.get('big.txt')
+        self.put('big.txt', b'small now')
+        cm.save({'type': 'file', 'format': 'text', 'content': u'edited'}, 'big.txt')
+        self.assertEqual(self.bucket.get_key('pre/big.txt').get_contents_as_string(), b'edited')
+
+
+@needs_moto
+class SaveTest(S3TestCase):
+
+    def test_last_modified_is_the_time_s3_gave_the_save(self):
+        cm = self.make()
+        # a server whose clock is a day behind s3's
+        skewed = mock.Mock(wraps=datetime)
+        skewed.datetime.utcnow.return_value = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        with mock.patch('s3nb.ipy3.datetime', skewed):
+            for model, path in ((notebook_model(), 'a.ipynb'), ({'type': 'file', 'format': 'text', 'content': u'b'}, 'b.txt')):
+                saved = cm.save(model, path)
+                self.assertEqual(saved['last_modified'], parse_s3_time(
+                    self.bucket.get_key('pre/' + path).last_modified, S3_TIMEFORMAT_GET_KEY))
+
+    def test_saves_check_the_etag_the_client_read(self):
+        cm, other = self.make(), self.make()
+        cm.save(notebook_model(), 'a.ipynb')
+        first, second = cm.get('a.ipynb'), cm.get('a.ipynb')
+        self.assertEqual(first['etag'], self.bucket.get_key('pre/a.ipynb').etag)
+        second = cm.save(second, 'a.ipynb')
+        self.assertEqual(second['etag'], self.bucket.get_key('pre/a.ipynb').etag)
+        # another tab on the same server, then a server that never read it; moto ignores If-Match, s3 would 412
+        for manager in (cm, other):
+            manager.s3_transfer.upload = mock.Mock(wraps=manager.s3_transfer.upload)
+            manager.save(first, 'a.ipynb')
+            headers = manager.s3_transfer.upload.call_args[0][4]
+            self.assertEqual(headers['If-Match'], first['etag'])
+
+
+@needs_moto
+class DirectoryTest(S3TestCase):
+
+    def modified(self, name):
+        return parse_s3_time(self.bucket.get_key('pre/' + name).last_modified, S3_TIMEFORMAT_GET_KEY)
+
+    def test_last_modified_is_the_newest_key(self):
+        self.put('d/x.txt', b'x')
+        self.put('e/f/y.txt', b'y')
+        cm, other = self.make(), self.make()
+        listed = dict((m['name'], m['last_modified']) for m in cm.get('', type='directory')['content'])
+        self.assertEqual(listed['d'], self.modified('d/x.txt'))
+        self.assertEqual(cm.get('d', type='directory')['last_modified'], self.modified('d/x.txt'))
+        self.assertEqual(other.get('d', type='directory', content=False)['last_modified'], self.modified('d/x.txt'))
+        # nothing but folders in it
+        self.assertEqual(listed['e'], self.modified('e/f/y.txt'))
+        self.assertEqual(other.get('e', type='directory', content=False)['last_modified'], self.modified('e/f/y.txt'))
+
+        # s3 times are in whole seconds
+        time.sleep(1.1)
+        saved = cm.save({'type': 'file', 'format': 'text', 'content': u'z'}, 'd/z.txt')
+        self.assertGreater(saved['last_modified'], listed['d'])
+        self.assertEqual(cm.get('d', type='directory', content=False)['last_modified'], saved['last_modified'])
+
+
+@needs_moto
+class NotebookDownloadTest(S3TestCase):
+
+    def download(self, cm, path):
+        model = cm.get(path, type='file')
+        self.assertEqual(model['format'], 'text')
+        return nbformat.reads(model['content'], as_version=4)
+
+    def test_compressed_notebook(self):
+        cm = self.make(s3_compression='gzip')
+        cm.save(notebook_model('print(2)'), 'a.ipynb')
+        self.assertEqual(self.bucket.get_key('pre/a.ipynb').content_encoding, 'gzip')
+        self.assertEqual(self.download(cm, 'a.ipynb').cells[0].source, 'print(2)')
+
+    def test_notebook_with_blobs(self):
+        cm = self.make(s3_output_blobs=True, s3_blob_min_size=10, s3_file_preview_size=10)
+        model = notebook_model()
+        model['content'].cells[0].outputs.append(
+            nbformat.v4.new_output('display_data', {'text/plain': u'y' * 100}))
+        cm.save(model, 'a.ipynb')
+        self.assertNotIn(b'y' * 100, self.bucket.get_key('pre/a.ipynb').get_contents_as_string())
+        outputs = self.download(cm, 'a.ipynb').cells[0].outputs
+        self.assertEqual(outputs[0].data['text/plain'], u'y' * 100)
+
+
+@needs_moto
+class WriteBehindTest(S3TestCase):
+
+    def test_last_modified_stays_what_the_save_returned(self):
+        journal = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal)
+        # s3 times are in whole seconds, so the flush has to land in a later one than the save
+        cm = self.make(s3_write_behind=True, s3_write_behind_dir=journal, s3_write_behind_delay=1.1)
+        cm.save(notebook_model(), 'a.ipynb')
+        saved = cm.save(cm.get('a.ipynb'), 'a.ipynb')
+        self.assertIsNotNone(cm._write_behind.get('pre/a.ipynb'))
+        wait_for(lambda: cm._write_behind.get('pre/a.ipynb') is None)
+        self.assertGreater(parse_s3_time(self.bucket.get_key('pre/a.ipynb').last_modified, S3_TIMEFORMAT_GET_KEY),
+                           saved['last_modified'])
+        self.assertEqual(cm.get('a.ipynb', content=False)['last_modified'], saved['last_modified'])
+        self.assertEqual(cm.get('a.ipynb')['last_modified'], saved['last_modified'])
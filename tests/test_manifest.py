@@ -0,0 +1,119 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from s3nb import manifest
+from support import S3TestCase, needs_moto, notebook_model
+
+MANIFEST = 'pre/d/' + manifest.MANIFEST_NAME
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_build_from_a_listing(self):
+        keys = [
+            manifest.manifestkey('pre/d/', '2015-01-31T12:00:00.000Z', '"p"', 0),
+            manifest.manifestkey('pre/d/' + manifest.MANIFEST_NAME, '2015-01-31T12:00:00.000Z', '"m"', 10),
+            manifest.manifestkey('pre/d/a.ipynb', '2015-01-31T12:34:56.000Z', '"a"', 1),
+            manifest.manifestkey('pre/d/b.txt', '2015-01-31T12:34:57.000Z', '"b"', 2),
+            manifest.manifestkey('pre/d/e/', None, None, None),
+        ]
+        m = manifest.loads(manifest.dumps(manifest.build(keys, 'pre/d/')))
+        self.assertEqual(m['entries'], {
+            'a.ipynb': manifest.entry('notebook', 1, '"a"', '2015-01-31T12:34:56.000Z'),
+            'b.txt': manifest.entry('file', 2, '"b"', '2015-01-31T12:34:57.000Z'),
+            'e/': manifest.entry('directory'),
+        })
+        self.assertEqual(list(manifest.iter_keys(m, 'pre/d/')), keys[2:])
+
+    def test_other_versions_are_refused(self):
+        with self.assertRaises(ValueError):
+            manifest.loads(b'{"version": 2, "entries": {}}')
+
+    def test_listing_time(self):
+        self.assertEqual(manifest.listing_time('Sat, 31 Jan 2015 12:34:56 GMT'), '2015-01-31T12:34:56.000Z')
+
+
+@needs_moto
+class ManifestUpdateTest(S3TestCase):
+
+    def entries(self, key=MANIFEST):
+        return manifest.loads(self.bucket.get_key(key).get_contents_as_string())['entries']
+
+    def test_saves_leave_a_folder_without_one_alone(self):
+        cm = self.make(s3_manifests=True)
+        self.put('a.txt', b'a')
+        cm.get('', type='directory')
+        self.put('d/x.txt', b'x')
+        cm._iter_keys = mock.Mock(wraps=cm._iter_keys)
+        cm.save({'type': 'file', 'format': 'text', 'content': u'y'}, 'd/y.txt')
+        cm.save({'type': 'file', 'format': 'text', 'content': u'z'}, 'e/z.txt')
+        self.assertFalse(cm._iter_keys.called)
+        self.assertIsNone(self.bucket.get_key(MANIFEST))
+        # a new folder is still added to its parent's
+        self.assertEqual(sorted(self.entries('pre/' + manifest.MANIFEST_NAME)), ['a.txt', 'd/', 'e/'])
+
+        cm.get('d', type='directory')
+        self.assertEqual(sorted(self.entries()), ['x.txt', 'y.txt'])
+
+    def test_oversized_folders_get_none(self):
+        cm = self.make(s3_manifests=True, s3_cache_max_listing_keys=1)
+        self.put('d/x.txt', b'x')
+        self.put('d/y.txt', b'y')
+        self.assertEqual(len(cm.get('d', type='directory')['content']), 2)
+        cm.save({'type': 'file', 'format': 'text', 'content': u'z'}, 'd/z.txt')
+        self.assertIsNone(self.bucket.get_key(MANIFEST))
+
+    def test_updates_merge_into_it(self):
+        cm, other = self.make(s3_manifests=True), self.make(s3_manifests=True)
+        self.put('d/x.txt', b'x')
+        cm.get('d', type='directory')
+        cm.save({'type': 'file', 'format': 'text', 'content': u'y'}, 'd/y.txt')
+        other.save({'type': 'file', 'format': 'text', 'content': u'z'}, 'd/z.txt')
+        other.delete('d/x.txt')
+        entries = self.entries()
+        self.assertEqual(sorted(entries), ['y.txt', 'z.txt'])
+        self.assertEqual(entries['z.txt']['etag'], self.bucket.get_key('pre/d/z.txt').etag)
+        self.assertEqual(sorted(m['name'] for m in cm.get('d', type='directory')['content']), ['y.txt', 'z.txt'])
+
+    def test_an_update_that_lost_a_race_is_retried(self):
+        cm = self.make(s3_manifests=True)
+        self.put('d/x.txt', b'x')
+        cm.get('d', type='directory')
+        write = cm._write_manifest
+        attempts = []
+
+        def lose_once(key_dir, m, etag):
+            # as if someone else changed it between our read and our write
+            attempts.append(etag)
+            return len(attempts) > 1 and write(key_dir, m, etag)
+        cm._write_manifest = lose_once
+        cm.save({'type': 'file', 'format': 'text', 'content': u'y'}, 'd/y.txt')
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(sorted(self.entries()), ['x.txt', 'y.txt'])
+
+    def test_emptied_folders_lose_it(self):
+        cm = self.make(s3_manifests=True)
+        cm.save({'type': 'file', 'format': 'text', 'content': u'x'}, 'a.txt')
+        cm.get('', type='directory')
+        cm.save({'type': 'file', 'format': 'text', 'content': u'x'}, 'd/x.txt')
+        cm.get('d', type='directory')
+        cm.delete('d/x.txt')
+        self.assertIsNone(self.bucket.get_key(MANIFEST))
+        self.assertEqual(sorted(self.entries('pre/' + manifest.MANIFEST_NAME)), ['a.txt'])
+
+    def test_restoring_a_checkpoint_updates_it(self):
+        cm = self.make(s3_manifests=True, checkpoints_class='s3nb.checkpoints.S3Checkpoints')
+        cm.save(notebook_model('print(1)'), 'd/a.ipynb')
+        cm.get('d', type='directory')
+        checkpoint = cm.create_checkpoint('d/a.ipynb')
+        cm.save(notebook_model('print(2)'), 'd/a.ipynb')
+        cm.restore_checkpoint(checkpoint['id'], 'd/a.ipynb')
+        self.assertEqual(self.entries()['a.ipynb']['etag'], self.bucket.get_key('pre/d/a.ipynb').etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
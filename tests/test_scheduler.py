@@ -0,0 +1,105 @@
+import threading
+import unittest
+
+from s3nb import scheduler
+from s3nb.scheduler import BACKGROUND, INTERACTIVE, NORMAL, TokenBucket
+from support import FakeClock, wait_for
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def drain(self, tb):
+        while tb.tokens >= 1:
+            tb.acquire()
+
+    def test_refills_at_its_rate_up_to_a_seconds_worth(self):
+        tb = TokenBucket(4, self.clock)
+        self.drain(tb)
+        self.clock.advance(0.5)
+        for _ in range(2):
+            self.assertEqual(tb.acquire(), 0)
+        self.assertLess(tb.tokens, 1)
+
+        self.clock.advance(60)
+        tb._refill()
+        self.assertEqual(tb.tokens, 4)
+
+    def test_waiters_take_tokens_in_priority_order(self):
+        # steps of 1/64 add up exactly, so each one makes exactly one token
+        tb = TokenBucket(64, self.clock)
+        self.drain(tb)
+        taken = []
+
+        def take(name, priority):
+            tb.acquire(priority)
+            taken.append(name)
+
+        threads = []
+        for name, priority in (('save', BACKGROUND), ('list', NORMAL), ('open', INTERACTIVE)):
+            thread = threading.Thread(target=take, args=(name, priority))
+            # a failure here mustn't leave the test run waiting on them
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            wait_for(lambda: len(tb._waiting) == len(threads))
+        for i in range(3):
+            # one token at a time, to whoever is first in line
+            self.clock.advance(1 / 64.0)
+            wait_for(lambda: len(taken) == i + 1)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(taken, ['open', 'list', 'save'])
+
+    def test_throttling_halves_the_rate_once_per_window(self):
+        tb = TokenBucket(100, self.clock)
+        tb.throttled()
+        self.assertEqual(tb.rate, 50)
+        self.clock.advance(scheduler.THROTTLE_WINDOW / 2)
+        tb.throttled()
+        self.assertEqual(tb.rate, 50)
+        self.clock.advance(scheduler.THROTTLE_WINDOW)
+        tb.throttled()
+        self.assertEqual(tb.rate, 25)
+        self.assertLessEqual(tb.tokens, 25)
+        for _ in range(20):
+            self.clock.advance(scheduler.THROTTLE_WINDOW)
+            tb.throttled()
+        self.assertEqual(tb.rate, scheduler.MIN_RATE)
+
+    def test_rate_recovers_while_requests_succeed(self):
+        tb = TokenBucket(100, self.clock)
+        tb.throttled()
+        self.clock.advance(2)
+        tb.succeeded()
+        self.assertAlmostEqual(tb.rate, 50 + 100 * scheduler.RECOVERY * 2)
+        self.clock.advance(60)
+        tb.succeeded()
+        self.assertEqual(tb.rate, 100)
+
+
+class S3SchedulerTest(unittest.TestCase):
+
+    def test_prefixes(self):
+        s = scheduler.S3Scheduler(prefix_depth=2)
+        self.assertEqual(s.prefix('a/b/c.ipynb'), 'a/b')
+        self.assertEqual(s.prefix(''), '')
+        self.assertEqual(s.prefix('', 'prefix=a%2Fb%2Fc%2F&delimiter=%2F'), 'a/b')
+
+    def test_reads_and_writes_have_their_own_buckets(self):
+        s = scheduler.S3Scheduler(read_rate=10, write_rate=5, clock=FakeClock())
+        self.assertIs(s.token_bucket('bkt', 'a', 'GET'), s.token_bucket('bkt', 'a', 'LIST'))
+        self.assertEqual(s.token_bucket('bkt', 'a', 'GET').rate, 10)
+        self.assertEqual(s.token_bucket('bkt', 'a', 'PUT').rate, 5)
+        self.assertIsNot(s.token_bucket('bkt', 'a', 'GET'), s.token_bucket('bkt', 'b', 'GET'))
+
+    def test_backoff_is_capped(self):
+        s = scheduler.S3Scheduler(backoff_base=1, backoff_max=3)
+        for attempt in range(10):
+            self.assertLessEqual(s.backoff(attempt), min(3, 2 ** attempt))
+
+
+if __name__ == '__main__':
+    unittest.main()
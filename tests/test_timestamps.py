@@ -0,0 +1,52 @@
+import datetime
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from IPython.utils import tz
+
+from s3nb import timestamps
+from s3nb.timestamps import S3_TIMEFORMAT_BUCKET_LIST, S3_TIMEFORMAT_GET_KEY, parse_s3_time
+
+
+class ParseS3TimeTest(unittest.TestCase):
+
+    def setUp(self):
+        timestamps._memo.clear()
+
+    def times(self):
+        # every month, and single digit days and hours
+        for month in range(1, 13):
+            yield datetime.datetime(2015, month, 2 * month + 4, month, 4, 5, tzinfo=tz.UTC)
+
+    def test_both_formats(self):
+        for when in self.times():
+            for timeformat in (S3_TIMEFORMAT_BUCKET_LIST, S3_TIMEFORMAT_GET_KEY):
+                value = when.strftime(timeformat)
+                self.assertEqual(parse_s3_time(value, timeformat), when, value)
+                self.assertEqual(parse_s3_time(value, timeformat).tzinfo.utcoffset(when), datetime.timedelta(0))
+
+    def test_without_fromisoformat(self):
+        with mock.patch.object(timestamps, '_fromisoformat', None):
+            self.assertEqual(parse_s3_time('2015-01-31T12:34:56.000Z', S3_TIMEFORMAT_BUCKET_LIST),
+                             datetime.datetime(2015, 1, 31, 12, 34, 56, tzinfo=tz.UTC))
+
+    def test_other_formats_fall_back_to_strptime(self):
+        self.assertEqual(parse_s3_time('2015/01/31', '%Y/%m/%d'), datetime.datetime(2015, 1, 31, tzinfo=tz.UTC))
+        with self.assertRaises(ValueError):
+            parse_s3_time('Sat, 31 Foo 2015 12:34:56 GMT', S3_TIMEFORMAT_GET_KEY)
+
+    def test_memo_is_bounded(self):
+        value = '2015-01-31T12:34:56.000Z'
+        self.assertIs(parse_s3_time(value, S3_TIMEFORMAT_BUCKET_LIST), parse_s3_time(value, S3_TIMEFORMAT_BUCKET_LIST))
+        with mock.patch.object(timestamps, '_MEMO_SIZE', 2):
+            for second in range(10):
+                parse_s3_time('2015-01-31T12:34:%02d.000Z' % second, S3_TIMEFORMAT_BUCKET_LIST)
+            self.assertLessEqual(len(timestamps._memo), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from s3nb import writebehind
+from s3nb.writebehind import CONFLICT_SUFFIX, JOURNAL_SUFFIX, Conflict, WriteBehindQueue
+from support import wait_for
+
+
+class Recorder(object):
+    """ a flush that records what it was handed, or raises error """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.flushed = []
+        self.lock = threading.Lock()
+
+    def __call__(self, pending):
+        with self.lock:
+            self.flushed.append((pending.key, pending.path, pending.data, pending.headers, pending.etag))
+        if self.error is not None:
+            raise self.error
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close(5)
+        shutil.rmtree(self.directory)
+
+    def make(self, flush, namespace='bkt/pre/', **kwargs):
+        kwargs.setdefault('delay', 0.05)
+        queue = WriteBehindQueue(self.directory, flush, namespace=namespace, **kwargs)
+        self.queues.append(queue)
+        return queue
+
+    def files(self, suffix):
+        return [name for name in os.listdir(self.directory) if name.endswith(suffix)]
+
+    def test_saves_of_one_key_are_coalesced(self):
+        flush = Recorder()
+        queue = self.make(flush, delay=0.5)
+        for i in range(3):
+            self.assertTrue(queue.put('pre/a.ipynb', 'a.ipynb', b'version %d' % i, etag='"e"'))
+        self.assertEqual(queue.get('pre/a.ipynb').data, b'version 2')
+        self.assertEqual(len(self.files(JOURNAL_SUFFIX)), 1)
+        self.assertEqual(queue.flush_prefix('pre/', timeout=5), [])
+        self.assertEqual(flush.flushed, [('pre/a.ipynb', 'a.ipynb', b'version 2', {}, '"e"')])
+        self.assertIsNone(queue.get('pre/a.ipynb'))
+        self.assertEqual(self.files(JOURNAL_SUFFIX), [])
+
+    def test_replay_uploads_what_a_previous_process_left(self):
+        failing = self.make(Recorder(error=IOError('s3 is down')), delay=60)
+        failing.put('pre/a.ipynb', 'a.ipynb', b'unsaved', headers={'Content-Encoding': 'gzip'}, etag='"e"')
+        failing.close(5)
+        self.assertEqual(len(self.files(JOURNAL_SUFFIX)), 1)
+
+        other = self.make(Recorder(), namespace='bkt/other/')
+        self.assertEqual(other.replay(), 0)
+
+        flush = Recorder()
+        queue = self.make(flush)
+        self.assertEqual(queue.replay(), 1)
+        wait_for(lambda: queue.get('pre/a.ipynb') is None)
+        self.assertEqual(flush.flushed, [('pre/a.ipynb', 'a.ipynb', b'unsaved', {'Content-Encoding': 'gzip'}, '"e"')])
+        self.assertEqual(self.files(JOURNAL_SUFFIX), [])
+
+    def test_replay_discards_unacknowledged_writes(self):
+        with open(os.path.join(self.directory, '.partial.tmp'), 'wb') as f:
+            f.write(b'{"namespace"')
+        self.assertEqual(self.make(Recorder()).replay(), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_conflict_keeps_the_save(self):
+        queue = self.make(Recorder(error=Conflict('changed in s3')))
+        queue.put('pre/a.ipynb', 'a.ipynb', b'mine')
+        wait_for(lambda: queue.get('pre/a.ipynb') is None)
+        self.assertIn('pre/a.ipynb', queue.conflicts)
+        self.assertEqual(self.files(JOURNAL_SUFFIX), [])
+        conflicts = self.files(CONFLICT_SUFFIX)
+        self.assertEqual(len(conflicts), 1)
+        with open(os.path.join(self.directory, conflicts[0]), 'rb') as f:
+            self.assertEqual(writebehind.Pending.load(f).data, b'mine')
+        queue.resolved('pre/a.ipynb')
+        self.assertNotIn('pre/a.ipynb', queue.conflicts)
+
+    def test_failed_flushes_are_retried(self):
+        flush = Recorder(error=IOError('s3 is down'))
+        queue = self.make(flush, delay=0.01, max_backoff=0.05)
+        queue.put('pre/a.ipynb', 'a.ipynb', b'data')
+        wait_for(lambda: len(flush.flushed) >= 2)
+        flush.error = None
+        wait_for(lambda: queue.get('pre/a.ipynb') is None)
+        self.assertEqual(self.files(JOURNAL_SUFFIX), [])
+
+    def test_flusher_survives_a_missing_journal(self):
+        queue = self.make(Recorder())
+
+        def flush(pending):
+            # another process sharing the directory already removed it
+            os.remove(queue._path(pending.key))
+        queue.flush = flush
+        queue.put('pre/a.ipynb', 'a.ipynb', b'first')
+        wait_for(lambda: queue.get('pre/a.ipynb') is None)
+
+        flush = queue.flush = Recorder()
+        queue.put('pre/b.ipynb', 'b.ipynb', b'second')
+        self.assertEqual(queue.flush_prefix('pre/', timeout=5), [])
+        self.assertEqual([f[0] for f in flush.flushed], ['pre/b.ipynb'])
+
+    def test_full_queue_refuses_saves(self):
+        queue = self.make(Recorder(), delay=60, max_pending=1)
+        self.assertTrue(queue.put('pre/a.ipynb', 'a.ipynb', b'a'))
+        self.assertTrue(queue.put('pre/a.ipynb', 'a.ipynb', b'a again'))
+        self.assertFalse(queue.put('pre/b.ipynb', 'b.ipynb', b'b', timeout=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()